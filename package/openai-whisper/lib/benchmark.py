@@ -0,0 +1,521 @@
+from itertools import product, repeat
+from src.audio import to_audio_signal
+from src.loader import BasicSegmenter, WhisperDataLoader, stitch_fill_ratio, stitch_speech_segments
+from src.scheduler import BatchScheduler, TranscriptionRequest
+from src.segmenter import SpeechSegmenter
+from src.tokenizer import NoneTokenizer
+
+import argparse
+import json
+import multiprocessing
+import numpy as np
+import os
+import re
+import resource
+import subprocess
+import time
+import tracemalloc
+import wave
+
+# Transcript of jfk.wav, which the pipeline benchmark scores its transcriptions against.
+JFK_TEXT = "And so my fellow Americans, ask not what your country can do for you, ask what you can do for your country."
+
+
+def synthetic_speech_probs(duration, frame_size=0.02, seed=0):
+    """
+    Frame-level speech probabilities resembling a VAD's output: alternating bursts of speech and silence.
+    """
+
+    rng = np.random.default_rng(seed)
+    n_frames = int(duration / frame_size)
+    probs = np.empty(n_frames)
+    idx, speech = 0, False
+    while idx < n_frames:
+        run = int(rng.exponential(2.0 if speech else 1.0) / frame_size) + 1
+        level = 0.9 if speech else 0.05
+        probs[idx : idx + run] = np.clip(level + rng.normal(0, 0.15, min(run, n_frames - idx)), 0, 1)
+        idx += run
+        speech = not speech
+
+    start_times = np.arange(n_frames) * frame_size
+    end_times = np.minimum(duration, start_times + frame_size)
+    return np.stack([probs, start_times, end_times], axis=1)
+
+
+def timed(f, repeats):
+    elapsed = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = f()
+        elapsed.append(time.perf_counter() - start_time)
+    return result, min(elapsed)
+
+
+def benchmark_segmenter(args):
+    segmenter = SpeechSegmenter(base_path=None, vad_model=object())
+    results = []
+    for duration in args.durations:
+        speech_probs = synthetic_speech_probs(duration)
+        expected, loop_time = timed(
+            lambda: segmenter.get_speech_segments_loop(speech_probs), args.repeats
+        )
+        actual, vectorised_time = timed(
+            lambda: segmenter.get_speech_segments(speech_probs), args.repeats
+        )
+        clips = [synthetic_speech_probs(duration / args.clips, seed=seed) for seed in range(args.clips)]
+        _, batch_time = timed(
+            lambda: segmenter.get_speech_segments_batch(clips), args.repeats
+        )
+        results.append(
+            {
+                "duration": duration,
+                "segments": len(expected),
+                "identical": expected == actual,
+                "loopSeconds": loop_time,
+                "vectorisedSeconds": vectorised_time,
+                "batchSeconds": batch_time,
+                "speedup": loop_time / vectorised_time,
+            }
+        )
+    return results
+
+
+def synthetic_clips(n_clips, duration, seed=0):
+    """
+    16-bit PCM clips, generated one at a time.
+    """
+
+    rng = np.random.default_rng(seed)
+    for _ in range(n_clips):
+        yield (rng.normal(0, 1000, int(duration * 16000))).astype(np.int16).tobytes()
+
+
+def peak_memory(f):
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_memory(args):
+    """
+    Peak memory of the data loader as the number of clips grows, when clips are converted up front (eager),
+    and when they are streamed through it (streaming).
+    """
+
+    loader = WhisperDataLoader(
+        "cpu",
+        NoneTokenizer(),
+        None,
+        max_speech_len=args.max_speech_len,
+        max_resident_audio=args.max_resident_audio,
+    )
+
+    def run(audio_signals):
+        for _ in loader.get_batches(
+            loader.get_segments(audio_signals, repeat("en"), repeat("transcribe"), repeat(None), use_vad=False),
+            batch_size=args.batch_size,
+        ):
+            pass
+
+    results = []
+    for n_clips in args.clips:
+        clips = lambda: synthetic_clips(n_clips, args.duration)
+        results.append(
+            {
+                "clips": n_clips,
+                "audioSeconds": n_clips * args.duration,
+                "eagerPeakBytes": peak_memory(lambda: run(list(map(to_audio_signal, list(clips()))))),
+                "streamingPeakBytes": peak_memory(lambda: run(map(to_audio_signal, clips()))),
+            }
+        )
+    return results
+
+
+def synthetic_requests(n_requests, seed=0):
+    """
+    16-bit PCM clips with precomputed speech timestamps: a mix of short utterances and long monologues.
+    """
+
+    rng = np.random.default_rng(seed)
+    for _ in range(n_requests):
+        duration = float(np.clip(rng.lognormal(1.0, 1.2), 0.3, 28.0))
+        yield np.zeros(int(duration * 16000), dtype=np.int16).tobytes(), [[0.0, duration]]
+
+
+class SimulatedDecoder:
+    """
+    Stands in for WhisperModel.transcribe_segments. A greedy decoder runs one step per token of the longest
+    sequence in the batch, so each batch costs max(tokens) steps, while only sum(tokens) of them are useful.
+    """
+
+    def __init__(self, data_loader, tokens_per_second, step_seconds):
+        self.data_loader = data_loader
+        self.tokens_per_second = tokens_per_second
+        self.step_seconds = step_seconds
+        self.tokens = 0
+        self.seconds = 0.0
+
+    def decode(self, seq_lens):
+        tokens = [int(seq_len / 16000 * self.tokens_per_second) + 1 for seq_len in seq_lens]
+        self.tokens += sum(tokens)
+        self.seconds += max(tokens) * self.step_seconds
+
+    def profile_name(self, profile=None):
+        return None
+
+    def get_profile(self, profile=None):
+        return {}, {}
+
+    def transcribe_segments(self, segments, timings=None):
+        self.decode([_[3] for _ in segments])
+        return [{} for _ in segments]
+
+    def to_dict(self):
+        return {"tokens": self.tokens, "tokensPerSecond": self.tokens / self.seconds}
+
+
+def benchmark_bucketing(args):
+    results = []
+    for bucket_window in [None, args.bucket_window]:
+        loader = WhisperDataLoader("cpu", NoneTokenizer(), BasicSegmenter(), bucket_window=bucket_window)
+        requests = list(synthetic_requests(args.requests))
+
+        # Offline path: WhisperDataLoader.get_batches over every segment.
+        decoder = SimulatedDecoder(loader, args.tokens_per_second, args.step_seconds)
+        segments = loader.get_segments(
+            map(to_audio_signal, [_[0] for _ in requests]),
+            repeat("en"),
+            repeat("transcribe"),
+            repeat(None),
+            start_ends=[_[1] for _ in requests],
+        )
+        for _, _, seq_len, _ in loader.get_batches(segments, batch_size=args.batch_size):
+            decoder.decode(seq_len.tolist())
+        results.append({"path": "loader", "bucketWindow": bucket_window, **decoder.to_dict()})
+
+        # Online path: BatchScheduler, with every request pending at once.
+        decoder = SimulatedDecoder(loader, args.tokens_per_second, args.step_seconds)
+        scheduler = BatchScheduler(decoder, batch_size=args.batch_size, bucket_window=bucket_window)
+        for idx, (samples, start_ends) in enumerate(requests):
+            scheduler.submit(TranscriptionRequest(idx, [samples], start_ends=[start_ends]))
+        while scheduler.pending_count():
+            scheduler.run_batch()
+        results.append({"path": "scheduler", "bucketWindow": bucket_window, **decoder.to_dict()})
+
+    return results
+
+
+def benchmark_stitching(args):
+    """
+    Windows (i.e. encoder passes) and their fill ratio.
+    """
+
+    segmenter = SpeechSegmenter(base_path=None, vad_model=object(), max_seg_len=args.max_len)
+    results = []
+    for duration in args.durations:
+        start_ends = segmenter.get_speech_segments(synthetic_speech_probs(duration))
+        stitched, elapsed = timed(
+            lambda: stitch_speech_segments(start_ends, max_len=args.max_len), args.repeats
+        )
+        result = {
+            "duration": duration,
+            "segments": len(start_ends),
+            "windows": len(stitched),
+            "fillRatio": stitch_fill_ratio(stitched, max_len=args.max_len),
+            "seconds": elapsed,
+        }
+        results.append(result)
+    return results
+
+
+def percentiles(values):
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "max": float(np.max(values)),
+    }
+
+
+def benchmark_decode_budget(args):
+    """
+    Per batch decode latency on clips that are known to make Whisper hallucinate (short bursts of noise, hum and
+    clicks), with the duration proportional token budget and without it.
+    """
+
+    from src.model import WhisperModelCT2
+
+    model = WhisperModelCT2(
+        model_path=args.model_path,
+        device=args.device,
+        compute_type="float16" if args.device == "cuda" else "float32",
+    )
+
+    rng = np.random.default_rng(0)
+    clips = []
+    for idx in range(args.clips):
+        duration = rng.uniform(0.5, 2.0)
+        t = np.arange(int(duration * 16000)) / 16000
+        if idx % 3 == 0:
+            signal = rng.normal(0, 3000, len(t))
+        elif idx % 3 == 1:
+            signal = 8000 * np.sin(2 * np.pi * 50 * t)
+        else:
+            signal = 20000 * (rng.random(len(t)) < 0.001)
+        clips.append(signal.astype(np.int16).tobytes())
+
+    batches = [clips[idx : idx + args.batch_size] for idx in range(0, len(clips), args.batch_size)]
+    results = []
+    for max_tokens_per_second in [None, model.asr_options["max_tokens_per_second"]]:
+        model.asr_options["max_tokens_per_second"] = max_tokens_per_second
+        latencies, loops, truncated = [], 0, 0
+        for batch in batches:
+            start_ends = [[[0.0, len(clip) / 2 / 16000]] for clip in batch]
+            response, elapsed = timed(
+                lambda: model.transcribe_with_vad(batch, batch_size=args.batch_size, start_ends=start_ends), 1
+            )
+            latencies.append(elapsed)
+            loops += sum(_.get("repetitionLoop", False) for _ in response)
+            truncated += sum(_.get("truncated", False) for _ in response)
+        results.append(
+            {
+                "maxTokensPerSecond": max_tokens_per_second,
+                "repetitionLoops": loops,
+                "truncated": truncated,
+                "batchSeconds": percentiles(latencies),
+            }
+        )
+    return results
+
+
+def read_wav(path):
+    with wave.open(path, "rb") as wave_file:
+        return wave_file.readframes(wave_file.getnframes())
+
+
+def pipeline_corpus(jfk, seed=0):
+    """
+    Named sets of 16-bit PCM clips: jfk.wav itself (scored for accuracy), short slices and long concatenations of
+    it, silence, and noise.
+    """
+
+    rng = np.random.default_rng(seed)
+    jfk_duration = len(jfk) / 2 / 16000
+    short = []
+    for _ in range(16):
+        duration = rng.uniform(1.0, 3.0)
+        start = rng.uniform(0.0, jfk_duration - duration)
+        short.append(jfk[int(start * 16000) * 2 : int((start + duration) * 16000) * 2])
+
+    return {
+        "jfk": [jfk],
+        "short": short,
+        "long": [jfk * 6, jfk * 3],
+        "silence": [bytes(10 * 16000 * 2) for _ in range(4)],
+        "noise": [rng.normal(0, 2000, 5 * 16000).astype(np.int16).tobytes() for _ in range(4)],
+    }
+
+
+def normalize_text(text):
+    return re.sub(r"[^\w\s']", " ", text.lower()).split()
+
+
+def word_error_rate(reference, hypothesis):
+    """
+    Word level edit distance between both texts, over the length of the reference. Case and punctuation are ignored.
+    """
+
+    reference, hypothesis = normalize_text(reference), normalize_text(hypothesis)
+    distances = list(range(len(hypothesis) + 1))
+    for idx, word in enumerate(reference, 1):
+        previous, distances[0] = distances[0], idx
+        for jdx, _word in enumerate(hypothesis, 1):
+            previous, distances[jdx] = distances[jdx], min(
+                distances[jdx] + 1, distances[jdx - 1] + 1, previous + (word != _word)
+            )
+    return distances[-1] / max(1, len(reference))
+
+
+def run_pipeline_config(model_path, device, config, corpus, repeats):
+    """
+    Load a model with the given config, and transcribe the corpus with it. Runs in its own process, so that peak RSS
+    (and the model load) only covers this config.
+    """
+
+    from src.model import WhisperModelCT2
+
+    start_time = time.perf_counter()
+    model = WhisperModelCT2(
+        model_path=model_path,
+        device=device,
+        compute_type=config["computeType"],
+        cpu_threads=config["cpuThreads"],
+        merge_chunks=config["mergeChunks"],
+    )
+    load_seconds = time.perf_counter() - start_time
+
+    def transcribe(clips):
+        # Without the VAD, clips are cut into fixed windows instead (see WhisperDataLoader.fix_start_ends).
+        start_ends = None if config["vad"] else [[[0.0, len(clip) / 2 / 16000]] for clip in clips]
+        return model.transcribe_with_vad(clips, batch_size=config["batchSize"], start_ends=start_ends)
+
+    transcribe(corpus["jfk"])
+
+    # Throughput: each set as one offline call.
+    sets, text = {}, ""
+    for name, clips in corpus.items():
+        audio_seconds = sum(map(len, clips)) / 2 / 16000
+        response, seconds = timed(lambda: transcribe(clips), repeats)
+        sets[name] = {
+            "clips": len(clips),
+            "audioSeconds": audio_seconds,
+            "seconds": seconds,
+            "rtf": seconds / audio_seconds,
+        }
+        if name == "jfk":
+            text = " ".join(_["text"] for _ in response).strip()
+
+    # Latency: each clip on its own, like a worker request.
+    latencies = [timed(lambda: transcribe([clip]), 1)[1] for clips in corpus.values() for clip in clips]
+
+    audio_seconds = sum(_["audioSeconds"] for _ in sets.values())
+    seconds = sum(_["seconds"] for _ in sets.values())
+    return {
+        **config,
+        "loadSeconds": load_seconds,
+        "rtf": seconds / audio_seconds,
+        "audioSecondsPerSecond": audio_seconds / seconds,
+        "latencySeconds": percentiles(latencies),
+        # ru_maxrss is in kilobytes on Linux.
+        "peakRssBytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "jfk": {"text": text, "wer": word_error_rate(JFK_TEXT, text)},
+        "sets": sets,
+    }
+
+
+def benchmark_pipeline(args):
+    """
+    End to end RTF, throughput, latency, peak RSS and accuracy of WhisperModelCT2 over a fixed corpus, for every
+    combination of the swept options.
+    """
+
+    import ctranslate2
+    import torch
+
+    corpus = pipeline_corpus(read_wav(args.jfk), seed=args.seed)
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    runs = []
+    context = multiprocessing.get_context("spawn")
+    for batch_size, cpu_threads, compute_type, merge_chunks, vad in product(
+        args.batch_sizes, args.cpu_threads, args.compute_types, args.merge_chunks, args.vad
+    ):
+        config = {
+            "batchSize": batch_size,
+            "cpuThreads": cpu_threads,
+            "computeType": compute_type,
+            "mergeChunks": merge_chunks == "on",
+            "vad": vad == "on",
+        }
+        with context.Pool(1) as pool:
+            runs.append(
+                pool.apply(run_pipeline_config, (args.model_path, args.device, config, corpus, args.repeats))
+            )
+
+    return {
+        "environment": {
+            "commit": commit,
+            "cpuCount": os.cpu_count(),
+            "device": args.device,
+            "torch": torch.__version__,
+            "ctranslate2": ctranslate2.__version__,
+        },
+        "runs": runs,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the whisper worker.")
+    parser.add_argument("--output", help="Write the results to this JSON file instead of stdout.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    segmenter_parser = subparsers.add_parser(
+        "segmenter", help="SpeechSegmenter.get_speech_segments against the original frame-by-frame loop."
+    )
+    segmenter_parser.add_argument("--durations", type=float, nargs="+", default=[60.0, 600.0, 3600.0])
+    segmenter_parser.add_argument("--clips", type=int, default=64, help="Clips the batch API splits each recording into.")
+    segmenter_parser.add_argument("--repeats", type=int, default=3)
+    segmenter_parser.set_defaults(run=benchmark_segmenter)
+
+    memory_parser = subparsers.add_parser(
+        "memory", help="Peak memory of WhisperDataLoader, for eagerly converted and streamed clips."
+    )
+    memory_parser.add_argument("--clips", type=int, nargs="+", default=[16, 64, 256])
+    memory_parser.add_argument("--duration", type=float, default=10.0, help="Length of each clip, in seconds.")
+    memory_parser.add_argument("--batch-size", type=int, default=16)
+    memory_parser.add_argument("--max-speech-len", type=float, default=29.0)
+    memory_parser.add_argument("--max-resident-audio", type=float, default=None)
+    memory_parser.set_defaults(run=benchmark_memory)
+
+    bucketing_parser = subparsers.add_parser(
+        "bucketing", help="Simulated decoder throughput (tokens/sec), with and without length bucketing."
+    )
+    bucketing_parser.add_argument("--requests", type=int, default=1024)
+    bucketing_parser.add_argument("--batch-size", type=int, default=32)
+    bucketing_parser.add_argument("--bucket-window", type=int, default=128)
+    bucketing_parser.add_argument("--tokens-per-second", type=float, default=4.0, help="Tokens per second of speech.")
+    bucketing_parser.add_argument("--step-seconds", type=float, default=0.01, help="Cost of one decoder step.")
+    bucketing_parser.set_defaults(run=benchmark_bucketing)
+
+    stitching_parser = subparsers.add_parser(
+        "stitching", help="Windows and window fill ratio of stitch_speech_segments."
+    )
+    stitching_parser.add_argument("--durations", type=float, nargs="+", default=[60.0, 600.0, 3600.0])
+    stitching_parser.add_argument("--max-len", type=float, default=29.0)
+    stitching_parser.add_argument("--repeats", type=int, default=3)
+    stitching_parser.set_defaults(run=benchmark_stitching)
+
+    decode_budget_parser = subparsers.add_parser(
+        "decode-budget", help="Tail latency on clips known to hallucinate, with and without the decode budget."
+    )
+    decode_budget_parser.add_argument("--model-path", required=True)
+    decode_budget_parser.add_argument("--device", default="cpu")
+    decode_budget_parser.add_argument("--clips", type=int, default=96)
+    decode_budget_parser.add_argument("--batch-size", type=int, default=8)
+    decode_budget_parser.set_defaults(run=benchmark_decode_budget)
+
+    pipeline_parser = subparsers.add_parser(
+        "pipeline", help="End to end RTF, latency, peak RSS and jfk.wav accuracy, swept over model and loader options."
+    )
+    pipeline_parser.add_argument("--model-path", required=True)
+    pipeline_parser.add_argument("--device", default="cpu")
+    pipeline_parser.add_argument(
+        "--jfk", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "jfk.wav")
+    )
+    pipeline_parser.add_argument("--batch-sizes", type=int, nargs="+", default=[8, 32])
+    pipeline_parser.add_argument("--cpu-threads", type=int, nargs="+", default=[4])
+    pipeline_parser.add_argument("--compute-types", nargs="+", default=["float32"])
+    pipeline_parser.add_argument("--merge-chunks", nargs="+", choices=["on", "off"], default=["on", "off"])
+    pipeline_parser.add_argument("--vad", nargs="+", choices=["on", "off"], default=["on", "off"])
+    pipeline_parser.add_argument("--repeats", type=int, default=1)
+    pipeline_parser.add_argument("--seed", type=int, default=0)
+    pipeline_parser.set_defaults(run=benchmark_pipeline)
+
+    args = parser.parse_args()
+    results = json.dumps({"benchmark": args.benchmark, "results": args.run(args)}, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(results)
+    else:
+        print(results)
@@ -1,9 +1,52 @@
+import time
+
+# Startup is timed from here, before the heavy imports (torch, CTranslate2).
+startup_start_time = time.perf_counter()
+
+from src.cache import TranscriptionCache, model_revision
+from src.errors import is_fatal_error
 from src.model import WhisperModelCT2
+from src.profiling import ProfilingSession
+from src.protocol import ProtocolError, read_message, write_message
+from src.scheduler import BatchScheduler, TranscriptionRequest
+from src.stats import WorkerStats
+from src.timings import Timings
+import gc
 import json
+import numpy as np
+import queue
 import sys
+import threading
 import torch
 import traceback
-import base64
+
+# Taken from the WhisperS2T example. I'm assuming this is optimal for CTranslate2.
+BATCH_SIZE = 32
+
+# How long (in seconds) segments wait for other requests to join their batch.
+BATCH_WINDOW = 0.005
+
+# How many pending segments the scheduler considers when grouping segments of similar length into a batch.
+BUCKET_WINDOW = 4 * BATCH_SIZE
+
+# Memory budget (in bytes) of the transcription cache.
+CACHE_SIZE = 64 * 1024 * 1024
+
+# SQLite file the transcription cache is written through to, so that it survives restarts. None keeps it in memory.
+CACHE_PATH = None
+
+# How many times the model is reloaded after fatal errors (e.g. running out of GPU memory) before giving up.
+MAX_RESTARTS = 5
+
+# Seconds of history that rates, means and latency percentiles of {"stats": true} are computed over.
+STATS_WINDOW = 60.0
+
+# Directory profiling captures are written to.
+PROFILE_DIR = "profiles"
+
+# Whether a silent and a synthetic speech clip go through the whole pipeline before the worker reports ready, so that
+# the first request doesn't pay for lazy initialisation. Can be overridden by the startup config.
+WARMUP = False
 
 with open("pylog.txt", 'w') as file:
     try:
@@ -14,48 +57,305 @@ with open("pylog.txt", 'w') as file:
             stdin = sys.stdin.buffer
             stdout = sys.stdout.buffer
 
+            # Seconds spent in each startup phase, reported in the log and in the worker stats.
+            startup = Timings()
+            startup.add("imports", time.perf_counter() - startup_start_time)
+
             log("waiting for schema")
 
-            # Store the request schema.
-            model_path = stdin.readline().decode("utf-8-sig").strip()
+            # The first line is either the model path, or a JSON config: {"modelPath": ..., "warmup": true}
+            with startup.stage("config"):
+                config = stdin.readline().decode("utf-8-sig").strip()
+                config = json.loads(config) if config.startswith("{") else {"modelPath": config}
+            model_path = config["modelPath"]
+            warmup = config.get("warmup", WARMUP)
             log(f"model_path: {model_path}")
 
-            def respond(response):
-                print(json.dumps(response), flush=True)
+            # Responses are written in the same encoding (JSON line or binary frame) as the request.
+            # Both the main loop and the reader thread (for stats) write responses.
+            stdout_lock = threading.Lock()
+            def reply(request_id, binary, response):
+                if request_id is not None:
+                    response["requestId"] = request_id
+                with stdout_lock:
+                    write_message(stdout, response, binary)
+
+            def respond(request, response):
+                reply(request.request_id, request.binary, response)
+                if profiling is not None:
+                    profiling.requests += 1
+
+            # Log lines only hold a short summary of each request, never its audio.
+            def summary(request):
+                if request.timings is None:
+                    return ""
+                stages = request.timings.stages
+                return " (" + ", ".join(f"{name}: {stage['seconds']:.3f}s" for name, stage in stages.items()) + ")"
 
             # Initialize Whisper, and notify the process invoker whether CUDA is enabled or not.
             use_cuda = torch.cuda.is_available()
             log(f"cuda available: {use_cuda}")
-            model = WhisperModelCT2(
-                model_path=model_path,
-                device="cuda" if use_cuda else "cpu",
-                compute_type="float16" if use_cuda else "float32",
+            def load_model():
+                return WhisperModelCT2(
+                    model_path=model_path,
+                    device="cuda" if use_cuda else "cpu",
+                    compute_type="float16" if use_cuda else "float32",
+                )
+
+            # Runs a silent clip and a synthetic speech clip through the VAD, the mel spectrogram and the decoder.
+            def warm_up(model):
+                t = np.arange(3 * 16000) / 16000
+                voiced = sum(np.sin(2 * np.pi * 120 * k * t) / k for k in range(1, 10))
+                voiced *= 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t)
+                speech = (0.3 * 32767 * voiced / np.abs(voiced).max()).astype(np.int16).tobytes()
+                silence = bytes(2 * 16000)
+
+                # A scheduler of its own, so that neither the cache nor the stats see the warm-up.
+                warm_up_scheduler = BatchScheduler(model, batch_size=BATCH_SIZE)
+                warm_up_scheduler.submit(TranscriptionRequest(None, [silence, speech]))
+                # The speech clip is decoded even if the VAD doesn't take it for speech.
+                warm_up_scheduler.submit(TranscriptionRequest(None, [speech], start_ends=[[[0.0, 3.0]]]))
+                while warm_up_scheduler.pending_count():
+                    warm_up_scheduler.run_batch()
+
+            with startup.stage("loadModel"):
+                model = load_model()
+            startup.merge(model.load_timings)
+            if warmup:
+                with startup.stage("warmup"):
+                    warm_up(model)
+            cache = TranscriptionCache(
+                max_bytes=CACHE_SIZE, path=CACHE_PATH, revision=model_revision(model_path)
             )
+            stats = WorkerStats(window=STATS_WINDOW)
+            scheduler = BatchScheduler(
+                model,
+                batch_size=BATCH_SIZE,
+                max_wait=BATCH_WINDOW,
+                bucket_window=BUCKET_WINDOW,
+                cache=cache,
+                metrics=stats,
+            )
+            worker_stats = {
+                "errors": 0,
+                "fatalErrors": 0,
+                "restarts": 0,
+                "recoverySeconds": 0.0,
+                "lastRecoverySeconds": None,
+            }
+            startup.add("total", time.perf_counter() - startup_start_time)
+            worker_stats["startup"] = startup.to_dict()
+            log(f"startup: {json.dumps(worker_stats['startup'])}")
             print(str(use_cuda), flush=True)
 
-            def transcribe(request):
-                log(request)
-                samples_batch = request["samplesBatch"]
-                return model.transcribe_with_vad(
-                    samples_batch=[bytes(base64.b64decode(sample)) for sample in samples_batch],
-                    lang_codes=[request["language"]] * len(samples_batch),
-                    batch_size=32, # Taken from the WhisperS2T example. I'm assuming this is optimal for CTranslate2.
-                )
+            # Requests are read on a separate thread, so that new requests can join a batch while the current one runs.
+            inbox = queue.Queue()
+            def receive():
+                while True:
+                    try:
+                        message = read_message(stdin)
+                    except Exception as e:
+                        message = e
+                    if isinstance(message, tuple):
+                        # Deadlines count from when the request's first byte arrived, not from when the main loop
+                        # gets to it.
+                        message[0]["receiveTime"] = time.monotonic() - message[0]["decodeSeconds"]
+
+                    # Stats are answered right away, rather than once the running batch is done.
+                    if isinstance(message, tuple) and message[0].get("stats"):
+                        reply(
+                            message[0].get("requestId"),
+                            message[1],
+                            {
+                                "response": {
+                                    **stats.to_dict(),
+                                    "inbox": inbox.qsize(),
+                                    "queue": scheduler.stats(),
+                                    "cache": cache.stats(),
+                                    "worker": worker_stats,
+                                }
+                            },
+                        )
+                        continue
+
+                    inbox.put(message)
+                    if message is None:
+                        break
+            threading.Thread(target=receive, daemon=True).start()
+
+            # Running profiling capture, and who to send its trace path to once it's done.
+            profiling = None
+            profiling_reply_to = None
+
+            # Seconds until the next batch is due, or until the profiling capture should stop.
+            def next_timeout():
+                timeout = scheduler.timeout()
+                if profiling is not None:
+                    remaining = 0.0 if profiling.done else profiling.remaining()
+                    if remaining is not None:
+                        timeout = remaining if timeout is None else min(timeout, remaining)
+                return timeout
 
             running = True
             while running:
+                request = None
+                # Where errors are answered: the last message read, if it's still being handled.
+                reply_to = None
                 try:
-                    log("waiting recv")
-                    request_unparsed = stdin.readline().decode("utf-8-sig")
-                    log(f"request: {request_unparsed}")
-                    request = json.loads(request_unparsed)
-                    log("recv received")
-                    log("finished parsing request")
-                    respond({"response": transcribe(request)})
-                    log("finished sending response")
+                    # Gather requests until the next batch is due.
+                    timeout = next_timeout()
+                    while timeout != 0.0:
+                        log("waiting recv")
+                        reply_to = None
+                        try:
+                            message = inbox.get(timeout=timeout)
+                        except queue.Empty:
+                            break
+                        if message is None:
+                            log("stdin closed")
+                            running = False
+                            break
+                        if isinstance(message, Exception):
+                            # Messages that couldn't be read are answered with as much as could be parsed of them
+                            # (see ProtocolError), and without a request id otherwise.
+                            if isinstance(message, ProtocolError):
+                                reply_to = (message.request_id, message.binary)
+                            else:
+                                reply_to = (None, False)
+                            raise message
+                        message, binary = message
+                        decode_seconds = message.pop("decodeSeconds", 0.0)
+                        receive_time = message.pop("receiveTime", None)
+                        reply_to = (message.get("requestId"), binary)
+
+                        # Control messages are answered right away, and carry no audio.
+                        if message.get("cacheStats"):
+                            reply(*reply_to, {"response": cache.stats()})
+                            timeout = next_timeout()
+                            continue
+                        if message.get("queueStats"):
+                            reply(*reply_to, {"response": scheduler.stats()})
+                            timeout = next_timeout()
+                            continue
+                        if message.get("workerStats"):
+                            reply(*reply_to, {"response": worker_stats})
+                            timeout = next_timeout()
+                            continue
+
+                        # Profiling captures are answered once they're done, with the path of their trace.
+                        if "profiling" in message:
+                            if profiling is not None:
+                                raise ValueError("A profiling capture is already running.")
+                            options = message["profiling"]
+                            if not isinstance(options, dict):
+                                options = {}
+                            profiling = ProfilingSession(
+                                mode=options.get("mode", "torch"),
+                                requests=options.get("requests"),
+                                seconds=options.get("seconds"),
+                                directory=PROFILE_DIR,
+                            )
+                            profiling.start()
+                            profiling_reply_to = reply_to
+                            log(f"profiling: {profiling.mode} to {profiling.path}")
+                            timeout = next_timeout()
+                            continue
+
+                        # The cancelled request is answered, rather than the cancel message itself.
+                        if "cancel" in message:
+                            for cancelled in scheduler.cancel(message["cancel"]):
+                                respond(cancelled, cancelled.message())
+                                log(f"cancelled: {cancelled.request_id}")
+                            timeout = next_timeout()
+                            continue
+
+                        request = TranscriptionRequest(
+                            message.get("requestId"),
+                            message["samplesBatch"],
+                            lang_codes=message.get("language"),
+                            start_ends=message.get("speechTimestamps"),
+                            binary=binary,
+                            profile=message.get("profile"),
+                            priority=message.get("priority", "normal"),
+                            deadline_ms=message.get("deadlineMs"),
+                            timings=message.get("timings", False),
+                            receive_time=receive_time,
+                        )
+                        if request.timings is not None:
+                            request.timings.add(
+                                "bytesDecode",
+                                decode_seconds,
+                                bytes=sum(map(len, request.samples_batch)),
+                            )
+                        log(f"request: {request.request_id} ({len(request.samples_batch)} clips, binary: {binary})")
+
+                        # VAD-only requests ("is there speech?") don't need to wait for a batch.
+                        if message.get("vad"):
+                            response = {"response": model.detect_speech(request.samples_batch, request.timings)}
+                            scheduler.finish(request)
+                            if request.timings is not None:
+                                response["timings"] = request.timings.to_dict()
+                            respond(request, response)
+                            request = None
+                            timeout = next_timeout()
+                            continue
+
+                        for completed in scheduler.submit(request):
+                            respond(completed, completed.message())
+                        request = None
+                        timeout = next_timeout()
+
+                    reply_to = None
+                    if running:
+                        for completed in scheduler.run_batch():
+                            respond(completed, completed.message())
+                            log(f"finished sending response: {completed.request_id}{summary(completed)}")
+
+                    if profiling is not None and (profiling.done or not running):
+                        _profiling, profiling = profiling, None
+                        reply(*profiling_reply_to, {"response": _profiling.stop()})
+                        log(f"profiling done: {_profiling.path}")
                 except Exception as e:
-                    log(f"exception found.: {traceback.format_exc()}")
-                    respond({"exception": traceback.format_exc()})
-                    running = False
+                    error = traceback.format_exc()
+                    log(f"exception found.: {error}")
+                    if not is_fatal_error(e):
+                        # Only the request or message being handled fails. Batch failures are handled by the scheduler.
+                        worker_stats["errors"] += 1
+                        if request is not None:
+                            respond(request, {"exception": error})
+                        elif reply_to is not None:
+                            reply(*reply_to, {"exception": error})
+                        continue
+
+                    # The model can't be trusted after a fatal error, so every in-flight request fails with it,
+                    # and the model is reloaded in place.
+                    worker_stats["fatalErrors"] += 1
+                    failed = scheduler.fail_all(error)
+                    if request is not None and request not in failed:
+                        failed.append(request)
+                    for _request in failed:
+                        respond(_request, {"exception": error})
+
+                    if worker_stats["restarts"] >= MAX_RESTARTS:
+                        log("too many restarts, exiting")
+                        running = False
+                        continue
+
+                    log("reloading model")
+                    start_time = time.perf_counter()
+                    scheduler.model = model = None
+                    gc.collect()
+                    if use_cuda:
+                        torch.cuda.empty_cache()
+                    model = load_model()
+                    if warmup:
+                        warm_up(model)
+                    scheduler.model = model
+                    recovery_seconds = time.perf_counter() - start_time
+                    worker_stats["restarts"] += 1
+                    worker_stats["recoverySeconds"] += recovery_seconds
+                    worker_stats["lastRecoverySeconds"] = recovery_seconds
+                    log(f"model reloaded in {recovery_seconds:.3f}s")
+            cache.close()
     except Exception as e:
-        log(f"exception found.: {traceback.format_exc()}")
\ No newline at end of file
+        log(f"exception found.: {traceback.format_exc()}")
@@ -13,7 +13,10 @@ import torch.nn.functional as F
 
 
 def to_audio_signal(samples):
-    return np.frombuffer(samples, np.int16).flatten().astype(np.float32) / 32768.0
+    # np.frombuffer is a view over the PCM bytes, so the float32 conversion is the only copy.
+    audio_signal = np.frombuffer(samples, np.int16).astype(np.float32)
+    audio_signal /= 32768.0
+    return audio_signal
 
 
 def pad_or_trim(array, length: int = N_SAMPLES, *, axis: int = -1):
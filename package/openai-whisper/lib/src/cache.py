@@ -0,0 +1,160 @@
+# Content-addressed cache of transcriptions.
+#
+# The same clip is often transcribed more than once (repeated playback, retries, identical clips across lobbies).
+# Clips are keyed by a hash of their PCM bytes, along with everything else that affects their transcription.
+# Entries are kept in memory up to a byte budget, evicting the least recently used ones, and can optionally be
+# written through to an SQLite file, so that they survive worker restarts.
+#
+# Transcriptions depend on the model, so the cache is tied to a model revision (see model_revision). Keys include it,
+# and an SQLite file written with another revision is cleared when it is opened.
+
+from collections import OrderedDict
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+try:
+    import xxhash
+
+    def _hasher():
+        return xxhash.xxh3_128()
+
+except ImportError:
+
+    def _hasher():
+        return hashlib.blake2b(digest_size=16)
+
+
+def model_revision(model_path):
+    """
+    Identifies the contents of a model directory: its path, along with the size and mtime of each file in it.
+    """
+
+    hasher = _hasher()
+    hasher.update(os.path.abspath(model_path).encode("utf-8"))
+    for name in sorted(os.listdir(model_path)):
+        file_path = os.path.join(model_path, name)
+        if os.path.isfile(file_path):
+            stat = os.stat(file_path)
+            hasher.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class TranscriptionCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, path=None, revision=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.revision = revision
+
+        # key -> JSON encoded results. Stored encoded, so that callers can't mutate cached results.
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS transcriptions (key TEXT PRIMARY KEY, results TEXT NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)"
+            )
+
+            # Transcriptions of another model are dropped, rather than left to pile up unreachable.
+            row = self.db.execute(
+                "SELECT value FROM metadata WHERE name = 'revision'"
+            ).fetchone()
+            if row is None or row[0] != str(revision):
+                self.db.execute("DELETE FROM transcriptions")
+                self.db.execute(
+                    "INSERT OR REPLACE INTO metadata (name, value) VALUES ('revision', ?)",
+                    (str(revision),),
+                )
+            self.db.commit()
+
+    def key(self, samples, **options):
+        """
+        Hash of the clip's PCM bytes, of every option (language, task, prompt, ...) that affects its results, and of
+        the model revision.
+        """
+
+        hasher = _hasher()
+        hasher.update(samples)
+        hasher.update(
+            json.dumps(
+                {**options, "revision": self.revision}, sort_keys=True, default=str
+            ).encode("utf-8")
+        )
+        return hasher.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            results = self.entries.get(key)
+            if results is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(results)
+
+            if self.db is not None:
+                row = self.db.execute(
+                    "SELECT results FROM transcriptions WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    self._insert(key, row[0])
+                    self.disk_hits += 1
+                    return json.loads(row[0])
+
+            self.misses += 1
+            return None
+
+    def put(self, key, results):
+        results = json.dumps(results)
+        with self.lock:
+            self._insert(key, results)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO transcriptions (key, results) VALUES (?, ?)",
+                    (key, results),
+                )
+                self.db.commit()
+
+    def _insert(self, key, results):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+
+        # Entries larger than the whole budget are only kept on disk.
+        if len(results) > self.max_bytes:
+            return
+
+        self.entries[key] = results
+        self.size += len(results)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "diskHits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "maxBytes": self.max_bytes,
+            }
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,26 @@
+# Telling apart errors that only concern one request from those that leave the worker unusable.
+#
+# Most errors (a malformed clip, an unknown language, ...) only fail the request they came from. Running out of
+# memory or a CUDA fault can leave torch and CTranslate2 in a broken state, so the model is reloaded instead.
+
+# Substrings of the RuntimeError messages raised by torch and CTranslate2 on such faults.
+FATAL_MESSAGES = (
+    "out of memory",
+    "cuda error",
+    "cuda failed",
+    "cublas",
+    "cudnn",
+    "device-side assert",
+    "illegal memory access",
+)
+
+
+def is_fatal_error(exception):
+    if isinstance(exception, MemoryError):
+        return True
+
+    if isinstance(exception, RuntimeError):
+        message = str(exception).lower()
+        return any(_ in message for _ in FATAL_MESSAGES)
+
+    return False
@@ -4,6 +4,7 @@
 # Credits: https://github.com/shashikg/WhisperS2T
 
 from abc import ABC, abstractmethod
+import math
 import os
 import torch
 import numpy as np
@@ -22,6 +23,69 @@ class VADBaseClass(ABC):
         pass
 
 
+class SpeechProbs:
+    """
+    Frame-level speech probabilities of a clip, stored as a single float32 vector.
+    Frame times follow from the frame index, so they are only computed for the frames that are asked for.
+    """
+
+    def __init__(self, probs, frame_size, audio_duration):
+        self.frame_size = frame_size
+        self.audio_duration = audio_duration
+
+        # Frames starting at or after the end of the audio are dropped.
+        n_frames = math.ceil(audio_duration / frame_size)
+        while n_frames > 0 and (n_frames - 1) * frame_size >= audio_duration:
+            n_frames -= 1
+        while n_frames * frame_size < audio_duration:
+            n_frames += 1
+        self.probs = probs[:n_frames]
+
+        # Explicit [start_times, end_times], only set when adapting the array form.
+        self._times = None
+
+    @classmethod
+    def from_array(cls, vad_times, frame_size):
+        """
+        Adapt the [prob, start_time, end_time] array form.
+        """
+
+        vad_times = np.asarray(vad_times).reshape(-1, 3)
+        audio_duration = vad_times[-1, 2] if len(vad_times) else 0.0
+        speech_probs = cls(vad_times[:, 0], frame_size, audio_duration)
+        speech_probs.probs = vad_times[:, 0]
+        speech_probs._times = (vad_times[:, 1], vad_times[:, 2])
+        return speech_probs
+
+    def __len__(self):
+        return len(self.probs)
+
+    def frame_start(self, idx):
+        if self._times is not None:
+            return self._times[0][idx]
+        return idx * self.frame_size
+
+    def frame_end(self, idx):
+        if self._times is not None:
+            return self._times[1][idx]
+        return np.minimum(self.audio_duration, (idx + 1) * self.frame_size)
+
+    def to_array(self):
+        """
+        The [prob, start_time, end_time] array form, as FrameVAD used to return.
+        """
+
+        idx = np.arange(len(self.probs))
+        return np.stack(
+            [self.probs.astype(np.float64), self.frame_start(idx), self.frame_end(idx)],
+            axis=1,
+        )
+
+    def __array__(self, dtype=None, copy=None):
+        vad_times = self.to_array()
+        return vad_times if dtype is None else vad_times.astype(dtype)
+
+
 class FrameVAD(VADBaseClass):
     def __init__(
         self,
@@ -31,6 +95,8 @@ class FrameVAD(VADBaseClass):
         margin_size=1.0,
         frame_size=0.02,
         batch_size=4,
+        min_chunk_size=4.0,
+        short_batch_size=64,
         sampling_rate=16000,
     ):
 
@@ -61,7 +127,9 @@ class FrameVAD(VADBaseClass):
         self.vad_model.eval()
 
         self.batch_size = batch_size
+        self.short_batch_size = short_batch_size
         self.frame_size = frame_size
+        self.min_chunk_size = min_chunk_size
         self.chunk_size = chunk_size
         self.margin_size = margin_size
 
@@ -73,6 +141,8 @@ class FrameVAD(VADBaseClass):
             self.signal_chunk_len - 2 * int(self.margin_size * self.sampling_rate)
         )
 
+        self.min_signal_chunk_len = int(self.min_chunk_size * self.sampling_rate)
+
         self.margin_logit_len = int(self.margin_size / self.frame_size)
         self.signal_to_logit_len = int(self.frame_size * self.sampling_rate)
 
@@ -85,20 +155,49 @@ class FrameVAD(VADBaseClass):
 
         self._init_params()
 
+    def get_short_chunk_len(self, signal_len):
+        """
+        Clips shorter than a chunk are padded to the next power-of-two multiple of min_chunk_size instead.
+        The model's output depends on how much padding follows the audio: below about 4 s, speech probabilities of
+        short clips drift far enough from those of a full chunk to change the detected segments.
+        """
+
+        chunk_len = self.min_signal_chunk_len
+        while chunk_len < signal_len:
+            chunk_len *= 2
+
+        return min(chunk_len, self.signal_chunk_len)
+
     def prepare_input_batch(self, audio_signal):
-        input_signal = []
-        input_signal_length = []
-        for s_idx in range(0, len(audio_signal), self.signal_stride):
-            _signal = audio_signal[s_idx : s_idx + self.signal_chunk_len]
-            _signal_len = len(_signal)
-            input_signal.append(_signal)
-            input_signal_length.append(_signal_len)
-
-            if _signal_len < self.signal_chunk_len:
-                input_signal[-1] = np.pad(
-                    input_signal[-1], (0, self.signal_chunk_len - _signal_len)
-                )
-                break
+        """
+        Split the audio into overlapping chunks of signal_chunk_len, every signal_stride samples.
+        The chunks are a single strided view over the audio (only padded, and therefore copied, when the last chunk
+        is partial), rather than a list of slices.
+        """
+
+        signal_len = len(audio_signal)
+        if signal_len >= self.signal_chunk_len:
+            n_full_chunks = (signal_len - self.signal_chunk_len) // self.signal_stride + 1
+        else:
+            n_full_chunks = 0
+
+        # The audio left after the last full chunk (if any) goes into a final, partial chunk.
+        n_chunks = n_full_chunks + int(n_full_chunks * self.signal_stride < signal_len)
+        padded_len = max(0, n_chunks - 1) * self.signal_stride + self.signal_chunk_len
+
+        if padded_len > signal_len:
+            padded_signal = np.zeros(padded_len, dtype=audio_signal.dtype)
+            padded_signal[:signal_len] = audio_signal
+        else:
+            padded_signal = audio_signal
+
+        input_signal = np.lib.stride_tricks.sliding_window_view(
+            padded_signal, self.signal_chunk_len, writeable=True
+        )[:: self.signal_stride][:n_chunks]
+        input_signal_length = np.minimum(
+            self.signal_chunk_len,
+            signal_len - np.arange(n_chunks) * self.signal_stride,
+        )
 
         return input_signal, input_signal_length
 
@@ -106,17 +205,18 @@ class FrameVAD(VADBaseClass):
     @torch.no_grad()
     def forward(self, input_signal, input_signal_length):
 
+        # Converted once. Every batch below is a view over the same (strided) memory.
+        input_signal = torch.from_numpy(input_signal)
+        input_signal_length = torch.from_numpy(np.asarray(input_signal_length))
+
         all_logits = []
         for s_idx in range(0, len(input_signal), self.batch_size):
-            input_signal_pt = torch.stack(
-                [
-                    torch.tensor(_, device=self.device)
-                    for _ in input_signal[s_idx : s_idx + self.batch_size]
-                ]
-            )
-            input_signal_length_pt = torch.tensor(
-                input_signal_length[s_idx : s_idx + self.batch_size], device=self.device
+            input_signal_pt = input_signal[s_idx : s_idx + self.batch_size].to(
+                self.device
             )
+            input_signal_length_pt = input_signal_length[
+                s_idx : s_idx + self.batch_size
+            ].to(self.device)
 
             x, x_len = self.vad_pp(input_signal_pt, input_signal_length_pt)
             logits = self.vad_model(x, x_len)
@@ -138,20 +238,75 @@ class FrameVAD(VADBaseClass):
 
         return all_logits[:, 1].detach().cpu().numpy()
 
-    def __call__(self, audio_signal):
-        audio_duration = len(audio_signal) / self.sampling_rate
+    @torch.cuda.amp.autocast()
+    @torch.no_grad()
+    def forward_short(self, audio_signals):
+        """
+        Speech probabilities of clips shorter than a single chunk.
+        Clips are bucketed by their padded length, and each bucket runs through a single vad_pp/vad_model call.
+        """
+
+        buckets = {}
+        for idx, audio_signal in enumerate(audio_signals):
+            chunk_len = self.get_short_chunk_len(len(audio_signal))
+            buckets.setdefault(chunk_len, []).append(idx)
+
+        speech_probs = [None] * len(audio_signals)
+        for chunk_len, bucket in buckets.items():
+            for s_idx in range(0, len(bucket), self.short_batch_size):
+                _bucket = bucket[s_idx : s_idx + self.short_batch_size]
+                input_signal = np.zeros((len(_bucket), chunk_len), dtype=np.float32)
+                for row, idx in enumerate(_bucket):
+                    input_signal[row, : len(audio_signals[idx])] = audio_signals[idx]
+                input_signal_pt = torch.from_numpy(input_signal).to(self.device)
+                input_signal_length_pt = torch.tensor(
+                    [len(audio_signals[idx]) for idx in _bucket], device=self.device
+                )
+
+                x, x_len = self.vad_pp(input_signal_pt, input_signal_length_pt)
+                logits = self.vad_model(x, x_len)
 
-        input_signal, input_signal_length = self.prepare_input_batch(audio_signal)
-        speech_probs = self.forward(input_signal, input_signal_length)
+                for _logits, _len, idx in zip(logits, input_signal_length_pt, _bucket):
+                    _logits = torch.softmax(
+                        _logits[: int(_len / self.signal_to_logit_len)], dim=-1
+                    )
+                    speech_probs[idx] = _logits[:, 1].detach().cpu().numpy()
 
-        vad_times = []
-        for idx, prob in enumerate(speech_probs):
-            s_time = idx * self.frame_size
-            e_time = min(audio_duration, (idx + 1) * self.frame_size)
+        return speech_probs
 
-            if s_time >= e_time:
-                break
+    def get_speech_probs_batch(self, audio_signals):
+        speech_probs = [None] * len(audio_signals)
 
-            vad_times.append([prob, s_time, e_time])
+        short_idx = [
+            idx
+            for idx, audio_signal in enumerate(audio_signals)
+            if len(audio_signal) < self.signal_chunk_len
+        ]
+        if short_idx:
+            short_speech_probs = self.forward_short(
+                [audio_signals[idx] for idx in short_idx]
+            )
+            for idx, _speech_probs in zip(short_idx, short_speech_probs):
+                speech_probs[idx] = _speech_probs
+
+        for idx, audio_signal in enumerate(audio_signals):
+            if speech_probs[idx] is None:
+                input_signal, input_signal_length = self.prepare_input_batch(
+                    audio_signal
+                )
+                speech_probs[idx] = self.forward(input_signal, input_signal_length)
+
+        return speech_probs
 
-        return np.array(vad_times)
+    def call_batch(self, audio_signals):
+        return [
+            SpeechProbs(
+                speech_probs, self.frame_size, len(audio_signal) / self.sampling_rate
+            )
+            for speech_probs, audio_signal in zip(
+                self.get_speech_probs_batch(audio_signals), audio_signals
+            )
+        ]
+
+    def __call__(self, audio_signal):
+        return self.call_batch([audio_signal])[0]
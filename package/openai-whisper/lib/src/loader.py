@@ -5,6 +5,9 @@
 
 from whisper_s2t.configs import *
 from src.audio import pad_or_trim
+from src.timings import stage
+from collections import deque
+from itertools import repeat
 
 import torch
 import numpy as np
@@ -50,6 +53,20 @@ def stitch_speech_segments(start_ends, max_len=27.0, max_silent_region=None):
     return stitched_speech_segments_joined
 
 
+def stitch_fill_ratio(stitched_speech_segments, max_len=27.0):
+    """
+    Mean share of max_len filled with speech, across windows.
+    """
+
+    if not stitched_speech_segments:
+        return 0.0
+
+    speech_duration = sum(
+        end - start for segs in stitched_speech_segments for start, end in segs
+    )
+    return speech_duration / (len(stitched_speech_segments) * max_len)
+
+
 class BasicSegmenter:
     def __init__(self, max_seg_len=29.0, sampling_rate=16000):
         self.max_seg_len = max_seg_len
@@ -63,6 +80,10 @@ class BasicSegmenter:
         start_ends[-1][1] = min(audio_duration, start_ends[-1][1])  # fix edge
         return start_ends, audio_signal
 
+    def segment_batch(self, audio_signals, timings=None):
+        with stage(timings, "segmentation"):
+            return [self(audio_signal)[0] for audio_signal in audio_signals]
+
 
 class WhisperDataset(torch.utils.data.Dataset):
     def __init__(
@@ -131,6 +152,10 @@ class WhisperDataLoader:
         max_initial_prompt_len=223,
         merge_chunks=True,
         use_dynamic_time_axis=False,
+        pack_gap=1.0,
+        vad_batch_size=16,
+        max_resident_audio=None,
+        bucket_window=None,
     ):
 
         self.device = device
@@ -143,6 +168,16 @@ class WhisperDataLoader:
         self.max_initial_prompt_len = max_initial_prompt_len
         self.use_dynamic_time_axis = use_dynamic_time_axis
         self.merge_chunks = merge_chunks
+        self.pack_gap = pack_gap
+        self.vad_batch_size = vad_batch_size
+
+        # Soft cap (in seconds) on the audio held by the loader at once. None means unbounded.
+        self.max_resident_samples = (
+            None if max_resident_audio is None else int(max_resident_audio * SAMPLE_RATE)
+        )
+
+        # Number of segments gathered and sorted by length before they are batched. None batches in arrival order.
+        self.bucket_window = bucket_window
 
     def data_collate_fn(self, batch):
         if self.use_dynamic_time_axis:
@@ -180,9 +215,21 @@ class WhisperDataLoader:
             return signal_batch, prompt_batch, seq_len
 
     def get_segmented_audio_signal(
-        self, start_ends, audio_signal, file_id, lang, task, initial_prompt, sr=16000
+        self,
+        start_ends,
+        audio_signal,
+        file_id,
+        lang,
+        task,
+        initial_prompt,
+        sr=16000,
+        profile=None,
     ):
 
+        # No speech was found, so there is nothing to decode.
+        if len(start_ends) == 0:
+            return []
+
         if initial_prompt:
             initial_prompt = " " + initial_prompt.strip()
             initial_prompt_tokens = self.tokenizer.encode(initial_prompt)[
@@ -217,6 +264,7 @@ class WhisperDataLoader:
                     "end_time": stitched_seg[-1][1],
                     "stitched_seg": stitched_seg,
                     "lang_code": lang,
+                    "profile": profile,
                 }
                 segmented_audio_signal.append(
                     (audio, prompt, initial_prompt_tokens, seq_len, seg_metadata)
@@ -231,59 +279,229 @@ class WhisperDataLoader:
                         prompt,
                         initial_prompt_tokens,
                         seq_len,
-                        {"file_id": file_id, "start_time": st, "end_time": et},
+                        {
+                            "file_id": file_id,
+                            "start_time": st,
+                            "end_time": et,
+                            "profile": profile,
+                        },
                     )
                 )
 
         return segmented_audio_signal
 
+    def pack_window(self, window, sr=16000):
+        # Windows holding a single segment are packed as well: every window of a batch must be decoded with the
+        # same prompt layout, as generate doesn't take prompts with different numbers of task tokens.
+        gap = np.zeros(int(self.pack_gap * sr), dtype=np.float32)
+        audio, packed_segs, offset = [], [], 0
+        for idx, (_audio, _, _, _seq_len, _) in enumerate(window):
+            if idx > 0:
+                audio.append(gap)
+                offset += len(gap)
+            audio.append(_audio)
+            packed_segs.append([offset / sr, (offset + _seq_len) / sr])
+            offset += _seq_len
+
+        audio = np.concatenate(audio)
+
+        # Packed windows are always decoded with timestamps, which are used to split the text back per segment.
+        prompt = [_ for _ in window[0][1] if _ != self.tokenizer.no_timestamps]
+        if prompt[-1] != self.tokenizer.timestamp_begin:
+            prompt.append(self.tokenizer.timestamp_begin)
+
+        seg_metadata = {
+            "file_id": None,
+            "start_time": 0.0,
+            "end_time": offset / sr,
+            "lang_code": window[0][4].get("lang_code"),
+            "profile": window[0][4].get("profile"),
+            "packed_segs": packed_segs,
+            "packed_metadata": [_[4] for _ in window],
+        }
+        return audio, prompt, window[0][2], audio.shape[-1], seg_metadata
+
+    def pack_segments(self, segments, sr=16000):
+        """
+        Concatenate segments (possibly from different files or requests) into shared windows of up to
+        max_speech_len seconds, separated by pack_gap seconds of silence.
+        Only segments sharing the same prompt and ASR profile are packed together.
+        """
+
+        max_len = int(self.max_speech_len * sr)
+        gap_len = int(self.pack_gap * sr)
+        windows = {}
+        for segment in segments:
+            key = (tuple(segment[1]), tuple(segment[2]), segment[4].get("profile"))
+            window = windows.setdefault(key, [])
+            window_len = sum(_[3] for _ in window) + max(0, len(window) - 1) * gap_len
+            if window and window_len + gap_len + segment[3] > max_len:
+                yield self.pack_window(window, sr=sr)
+                window = windows[key] = []
+            window.append(segment)
+
+        for window in windows.values():
+            if window:
+                yield self.pack_window(window, sr=sr)
+
+    def fix_start_ends(self, start_ends, audio_signal, sr=16000):
+        """
+        Clamp precomputed speech timestamps to the audio, and split any segment longer than max_speech_len.
+        """
+
+        audio_duration = len(audio_signal) / sr
+        fixed_start_ends = []
+        for st, et in start_ends:
+            st, et = max(0.0, float(st)), min(audio_duration, float(et))
+            while et - st > self.max_speech_len:
+                fixed_start_ends.append([st, st + self.max_speech_len])
+                st += self.max_speech_len
+            if et > st:
+                fixed_start_ends.append([st, et])
+
+        return fixed_start_ends
+
+    def get_segments(
+        self,
+        audio_signals,
+        lang_codes,
+        tasks,
+        initial_prompts,
+        use_vad=True,
+        start_ends=None,
+        profile=None,
+        timings=None,
+    ):
+        """
+        Segment each audio signal, and yield its segments.
+        start_ends optionally holds precomputed speech timestamps (in seconds) per audio signal.
+        Audio signals with timestamps skip the speech segmenter entirely, while None falls back to it.
+        profile (the ASR profile to decode with) is carried in each segment's metadata.
+        timings is an optional src.timings.Timings, filled with the VAD and segmentation stages.
+        """
+
+        segmenter = self.speech_segmenter if use_vad else self.basic_segmenter
+        if start_ends is None:
+            start_ends = repeat(None)
+
+        files = enumerate(
+            zip(audio_signals, lang_codes, tasks, initial_prompts, start_ends)
+        )
+
+        for group in self.get_file_groups(files):
+            segmented = iter(
+                segmenter.segment_batch(
+                    [_[1][0] for _ in group if _[1][4] is None], timings
+                )
+            )
+
+            for file_id, (audio_signal, lang, task, initial_prompt, _start_ends) in group:
+                with stage(timings, "segmentation"):
+                    if _start_ends is None:
+                        _start_ends = next(segmented)
+                    else:
+                        _start_ends = self.fix_start_ends(_start_ends, audio_signal)
+
+                    segments = self.get_segmented_audio_signal(
+                        _start_ends,
+                        audio_signal,
+                        file_id,
+                        lang,
+                        task,
+                        initial_prompt,
+                        profile=profile,
+                    )
+
+                if timings is not None:
+                    timings.add("segmentation", segments=len(segments))
+                yield from segments
+
+    def get_file_groups(self, files):
+        """
+        Files are segmented in groups of vad_batch_size, so that their VAD runs in as few calls as possible.
+        Groups are cut short once they hold max_resident_audio.
+        """
+
+        group, group_samples = [], 0
+        for file in files:
+            group.append(file)
+            group_samples += len(file[1][0])
+            if len(group) >= self.vad_batch_size or (
+                self.max_resident_samples is not None
+                and group_samples >= self.max_resident_samples
+            ):
+                yield group
+                group, group_samples = [], 0
+
+        if group:
+            yield group
+
+    def bucket_segments(self, segments, batch_size=16):
+        """
+        Reorder segments so that batches hold segments of similar length. The decoder runs until the longest
+        sequence of a batch finishes, so a short segment batched with a long one mostly decodes padding.
+        Segments are gathered in windows of bucket_window (or up to max_resident_audio), and sorted within each.
+        """
+
+        window_size = max(self.bucket_window, batch_size)
+        window, window_samples = [], 0
+        for segment in segments:
+            window.append(segment)
+            window_samples += segment[3]
+            if len(window) >= window_size or (
+                self.max_resident_samples is not None
+                and window_samples >= self.max_resident_samples
+            ):
+                yield from sorted(window, key=lambda _: _[3])
+                window, window_samples = [], 0
+
+        yield from sorted(window, key=lambda _: _[3])
+
+    def get_batches(self, segments, batch_size=16):
+        """
+        Collate segments into batches, lazily. Pending segments are released as soon as their batch is yielded,
+        and a batch is yielded early once the pending segments hold max_resident_audio.
+        Segments are bucketed by length first when bucket_window is set, so results may come out of order.
+        """
+
+        if self.bucket_window:
+            segments = self.bucket_segments(segments, batch_size=batch_size)
+
+        pending, pending_samples = deque(), 0
+        for segment in segments:
+            pending.append(segment)
+            pending_samples += segment[3]
+            while len(pending) >= batch_size or (
+                self.max_resident_samples is not None
+                and pending_samples >= self.max_resident_samples
+            ):
+                batch = [pending.popleft() for _ in range(min(batch_size, len(pending)))]
+                pending_samples -= sum(_[3] for _ in batch)
+                yield self.data_collate_fn(batch)
+
+        while pending:
+            batch = [pending.popleft() for _ in range(min(batch_size, len(pending)))]
+            yield self.data_collate_fn(batch)
+
     def get_data_loader_with_vad(
         self, audio_signals, lang_codes, tasks, initial_prompts, batch_size=16
     ):
-        segmented_audio_signal = []
-        for file_id, (audio_signal, lang, task, initial_prompt) in enumerate(
-            zip(audio_signals, lang_codes, tasks, initial_prompts)
-        ):
-            start_ends, audio_signal = self.speech_segmenter(audio_signal=audio_signal)
-            new_segmented_audio_signal = self.get_segmented_audio_signal(
-                start_ends, audio_signal, file_id, lang, task, initial_prompt
-            )
-            segmented_audio_signal = segmented_audio_signal + new_segmented_audio_signal
-            while len(segmented_audio_signal) > batch_size:
-                batch = segmented_audio_signal[:batch_size]
-                segmented_audio_signal = segmented_audio_signal[batch_size:]
-                signal_batch, prompt_batch, seq_len, seg_metadata = (
-                    self.data_collate_fn(batch)
-                )
-                yield signal_batch, prompt_batch, seq_len, seg_metadata
-        signal_batch, prompt_batch, seq_len, seg_metadata = self.data_collate_fn(
-            segmented_audio_signal
+        return self.get_batches(
+            self.get_segments(
+                audio_signals, lang_codes, tasks, initial_prompts, use_vad=True
+            ),
+            batch_size=batch_size,
         )
-        yield signal_batch, prompt_batch, seq_len, seg_metadata
 
     def get_data_loader(
         self, audio_signals, lang_codes, tasks, initial_prompts, batch_size=16
     ):
-        segmented_audio_signal = []
-        for file_id, (audio_signal, lang, task, initial_prompt) in enumerate(
-            zip(audio_signals, lang_codes, tasks, initial_prompts)
-        ):
-            start_ends, audio_signal = self.basic_segmenter(audio_signal=audio_signal)
-            new_segmented_audio_signal = self.get_segmented_audio_signal(
-                start_ends, audio_signal, file_id, lang, task, initial_prompt
-            )
-            segmented_audio_signal = segmented_audio_signal + new_segmented_audio_signal
-            while len(segmented_audio_signal) > batch_size:
-                batch = segmented_audio_signal[:batch_size]
-                segmented_audio_signal = segmented_audio_signal[batch_size:]
-                signal_batch, prompt_batch, seq_len, seg_metadata = (
-                    self.data_collate_fn(batch)
-                )
-                yield signal_batch, prompt_batch, seq_len, seg_metadata
-        signal_batch, prompt_batch, seq_len, seg_metadata = self.data_collate_fn(
-            segmented_audio_signal
+        return self.get_batches(
+            self.get_segments(
+                audio_signals, lang_codes, tasks, initial_prompts, use_vad=False
+            ),
+            batch_size=batch_size,
         )
-        yield signal_batch, prompt_batch, seq_len, seg_metadata
 
     def __call__(
         self,
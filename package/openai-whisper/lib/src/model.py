@@ -4,15 +4,22 @@
 # Credits: https://github.com/shashikg/WhisperS2T
 
 from abc import ABC, abstractmethod
-from itertools import chain
+from collections import defaultdict
+from collections.abc import Sized
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 from src.frame_vad import FrameVAD
 from src.loader import WhisperDataLoader
 from src.audio import LogMelSpectogram, to_audio_signal
+from src.pipeline import StageTiming, run_pipeline
 from src.segmenter import SpeechSegmenter
+from src.timings import Timings, stage
 from src.tokenizer import NoneTokenizer, Tokenizer
 from whisper_s2t.configs import *
 
+import copy
 import os
+import time
 import numpy as np
 import ctranslate2
 import torch
@@ -27,7 +34,8 @@ FAST_ASR_OPTIONS = {
     "no_repeat_ngram_size": 0,
     "compression_ratio_threshold": 2.4,  # Placeholder
     "log_prob_threshold": -1.0,  # Placeholder
-    "no_speech_threshold": 0.5,  # Placeholder
+    "no_speech_threshold": 0.5,
+    "no_speech_early_exit": False,
     "prefix": None,  # Placeholder
     "suppress_blank": True,
     "suppress_tokens": [-1],
@@ -38,6 +46,11 @@ FAST_ASR_OPTIONS = {
     "return_scores": True,
     "return_no_speech_prob": True,
     "word_aligner_model": "tiny",
+    "max_tokens_per_second": 12,
+    "min_token_budget": 16,
+    "repetition_loop_max_ngram": 8,
+    "repetition_loop_min_repeats": 3,
+    "repetition_loop_min_tokens": 16,
 }
 
 
@@ -50,7 +63,8 @@ BEST_ASR_CONFIG = {
     "no_repeat_ngram_size": 0,
     "compression_ratio_threshold": 2.4,  # Placeholder
     "log_prob_threshold": -1.0,  # Placeholder
-    "no_speech_threshold": 0.5,  # Placeholder
+    "no_speech_threshold": 0.5,
+    "no_speech_early_exit": False,
     "prefix": None,  # Placeholder
     "suppress_blank": True,
     "suppress_tokens": [-1],
@@ -61,6 +75,18 @@ BEST_ASR_CONFIG = {
     "return_scores": True,
     "return_no_speech_prob": True,
     "word_aligner_model": "tiny",
+    "max_tokens_per_second": 12,
+    "min_token_budget": 16,
+    "repetition_loop_max_ngram": 8,
+    "repetition_loop_min_repeats": 3,
+    "repetition_loop_min_tokens": 16,
+}
+
+# Named sets of ASR options a request can pick from. "latency" (greedy) is meant for live transcriptions,
+# and "quality" (beam search) for background ones.
+ASR_PROFILES = {
+    "latency": FAST_ASR_OPTIONS,
+    "quality": BEST_ASR_CONFIG,
 }
 
 
@@ -75,6 +101,80 @@ def fix_batch_param(param, default_value, N):
     return param
 
 
+def fix_stream_param(param, default_value):
+    """
+    fix_batch_param, for batches whose length isn't known up front.
+    """
+
+    if param is None or type(param) == type(default_value):
+        return repeat(default_value if param is None else param)
+
+    return param
+
+
+def find_repetition_loop(tokens, max_ngram=8, min_repeats=3, min_tokens=16):
+    """
+    Detect a hallucinated repetition loop ("you you you ...") at the end of tokens.
+    Returns the length tokens should be cut to (keeping the first repeat), or None if there is no loop.
+    """
+
+    cut = None
+    for n in range(1, max_ngram + 1):
+        # The loop may have been cut off partway through an n-gram.
+        for offset in range(n):
+            end = len(tokens) - offset
+            ngram = tokens[end - n : end]
+            repeats = 1
+            while (
+                end - (repeats + 1) * n >= 0
+                and tokens[end - (repeats + 1) * n : end - repeats * n] == ngram
+            ):
+                repeats += 1
+
+            if repeats >= min_repeats and repeats * n + offset >= min_tokens:
+                loop_start = end - (repeats - 1) * n
+                if cut is None or loop_start < cut:
+                    cut = loop_start
+
+    return cut
+
+
+def budget_groups(budgets):
+    """
+    Split the indices of budgets into groups decoded by one generate call each. Every group takes the largest
+    remaining budget along with all budgets above half of it, so no sequence decodes past twice its own budget,
+    and equal budgets (e.g. max_tokens_per_second=None) stay in a single call.
+    """
+
+    order = sorted(range(len(budgets)), key=lambda _: -budgets[_])
+    groups = []
+    while order:
+        size = sum(1 for _ in order if budgets[_] * 2 > budgets[order[0]])
+        groups.append(sorted(order[:size]))
+        order = order[size:]
+
+    return groups
+
+
+def build_asr_profiles(asr_options):
+    """
+    The options of every profile in ASR_PROFILES, overridden by asr_options. Every profile gets its own copy of its
+    options and of the overrides, so that neither profiles nor models can leak state into each other.
+    """
+
+    return {name: copy.deepcopy({**options, **asr_options}) for name, options in ASR_PROFILES.items()}
+
+
+def no_speech_response(audio_duration):
+    return {
+        "text": "",
+        "startTime": 0.0,
+        "endTime": round(audio_duration, 3),
+        "noSpeechProb": 1.0,
+        "noSpeech": True,
+    }
+
+
 class WhisperModel(ABC):
     def __init__(
         self,
@@ -90,6 +190,10 @@ class WhisperModel(ABC):
         max_speech_len=29.0,
         max_text_token_len=MAX_TEXT_TOKEN_LENGTH,
         without_timestamps=True,
+        pack_segments=False,
+        pack_gap=1.0,
+        max_resident_audio=None,
+        bucket_window=None,
         speech_segmenter_options={},
     ):
 
@@ -108,6 +212,16 @@ class WhisperModel(ABC):
         self.without_timestamps = without_timestamps
         self.max_text_token_len = max_text_token_len
 
+        # Pack short segments from different files/requests into shared windows, to save encoder passes.
+        self.pack_segments = pack_segments
+        self.pack_gap = pack_gap
+
+        # Soft cap (in seconds) on the audio the data loader holds at once.
+        self.max_resident_audio = max_resident_audio
+
+        # Batch segments of similar length together (see WhisperDataLoader.bucket_segments).
+        self.bucket_window = bucket_window
+
         self.vad_model = vad_model
         self.speech_segmenter_options = speech_segmenter_options
         self.speech_segmenter_options["max_seg_len"] = self.max_speech_len
@@ -149,8 +263,29 @@ class WhisperModel(ABC):
             max_initial_prompt_len=self.max_initial_prompt_len,
             use_dynamic_time_axis=self.use_dynamic_time_axis,
             merge_chunks=self.merge_chunks,
+            pack_gap=self.pack_gap,
+            max_resident_audio=self.max_resident_audio,
+            bucket_window=self.bucket_window,
         )
 
+    def profile_name(self, profile=None):
+        """
+        Name of the given ASR profile, with None resolved to the default one.
+        """
+
+        if profile is not None:
+            raise ValueError(f"Unknown ASR profile: {profile}")
+
+        return None
+
+    def get_profile(self, profile=None):
+        """
+        ASR options and generate kwargs of the given ASR profile (None for the default one).
+        """
+
+        self.profile_name(profile)
+        return {}, {}
+
     def update_params(self, params={}):
         for key, value in params.items():
             setattr(self, key, value)
@@ -158,7 +293,9 @@ class WhisperModel(ABC):
         self._init_dependables()
 
     @abstractmethod
-    def generate_segment_batched(self, features, prompts):
+    def generate_segment_batched(
+        self, features, prompts, seq_lens, seg_metadata, timings=None
+    ):
         pass
 
     @torch.no_grad()
@@ -169,31 +306,202 @@ class WhisperModel(ABC):
         tasks=None,
         initial_prompts=None,
         batch_size=8,
+        start_ends=None,
+        pipelined=False,
+        stage_timings=None,
+        profile=None,
     ):
-        lang_codes = fix_batch_param(lang_codes, "en", len(samples_batch))
-        tasks = fix_batch_param(tasks, "transcribe", len(samples_batch))
-        initial_prompts = fix_batch_param(initial_prompts, None, len(samples_batch))
-        responses = [[] for _ in samples_batch]
-        for audio_signal, prompts, seq_len, seg_metadata in self.data_loader(
-            list(map(to_audio_signal, samples_batch)),
+        """
+        start_ends optionally holds precomputed speech timestamps per clip, as a list of [start, end] seconds.
+        Clips with timestamps skip the VAD. An empty list marks a clip as silent.
+
+        When pipelined is True, VAD/segmentation/collation of upcoming batches and mel extraction of the next batch
+        run on worker threads while the current batch decodes. When stage_timings is a dict, it is filled with the
+        StageTiming (time spent working and waiting) of each stage, see src/pipeline.py.
+
+        samples_batch may be any iterable (e.g. a generator reading clips from disk). Clips are converted lazily,
+        so only the clips the data loader is working on are held in memory.
+
+        profile names the set of ASR options (see ASR_PROFILES) to decode with, or None for the model's default.
+        """
+
+        self.get_profile(profile)
+
+        if isinstance(samples_batch, Sized):
+            lang_codes = fix_batch_param(lang_codes, "en", len(samples_batch))
+            tasks = fix_batch_param(tasks, "transcribe", len(samples_batch))
+            initial_prompts = fix_batch_param(initial_prompts, None, len(samples_batch))
+        else:
+            lang_codes = fix_stream_param(lang_codes, "en")
+            tasks = fix_stream_param(tasks, "transcribe")
+            initial_prompts = fix_stream_param(initial_prompts, None)
+
+        responses = defaultdict(list)
+        audio_durations = []
+
+        def audio_signals():
+            for samples in samples_batch:
+                audio_signal = to_audio_signal(samples)
+                audio_durations.append(len(audio_signal) / SAMPLE_RATE)
+                yield audio_signal
+
+        segments = self.data_loader.get_segments(
+            audio_signals(),
             lang_codes,
             tasks,
             initial_prompts,
-            batch_size=batch_size,
-        ):
-            mels, seq_len = self.preprocessor(audio_signal, seq_len)
-            res = self.generate_segment_batched(
-                mels.to(self.device), prompts, seq_len, seg_metadata
+            start_ends=start_ends,
+            profile=profile,
+        )
+        if self.pack_segments:
+            segments = self.data_loader.pack_segments(segments)
+        batches = self.data_loader.get_batches(segments, batch_size=batch_size)
+
+        if stage_timings is None:
+            stage_timings = {}
+
+        if pipelined:
+            features = run_pipeline(
+                ("segment", batches),
+                [("features", lambda _: self.extract_features(*_))],
+                timings=stage_timings,
+            )
+        else:
+            features = map(lambda _: self.extract_features(*_), batches)
+
+        # Time the decoder spends waiting on the front-end is what pipelining hides.
+        stage_timings["decode"] = decode_timing = StageTiming()
+        wait_start_time = time.perf_counter()
+        for mels, prompts, seq_len, seg_metadata in features:
+            start_time = time.perf_counter()
+            decode_timing.wait_seconds += start_time - wait_start_time
+            for _seg_metadata, res in self.decode_batch(
+                mels, prompts, seq_len, seg_metadata
+            ):
+                responses[_seg_metadata["file_id"]].append(res)
+            wait_start_time = time.perf_counter()
+            decode_timing.busy_seconds += wait_start_time - start_time
+            decode_timing.items += 1
+
+        response = []
+        for file_id, audio_duration in enumerate(audio_durations):
+            # Packed and bucketed segments are not necessarily transcribed in the same order they were found.
+            _responses = sorted(responses.pop(file_id, []), key=lambda _: _["startTime"])
+
+            # Clips without any speech skip decoding, and are flagged instead.
+            if not _responses:
+                _responses.append(no_speech_response(audio_duration))
+
+            response.extend(_responses)
+
+        return response
+
+    @torch.no_grad()
+    def detect_speech(self, samples_batch, timings=None):
+        """
+        Run only the VAD over each clip. This is a fraction of the cost of a transcription.
+        """
+
+        with stage(timings, "toAudioSignal", clips=len(samples_batch)):
+            audio_signals = list(map(to_audio_signal, samples_batch))
+
+        responses = []
+        for speech in self.speech_segmenter.detect_speech_batch(audio_signals, timings):
+            responses.append(
+                {
+                    "speech": len(speech["start_ends"]) > 0,
+                    "speechRatio": round(speech["speech_ratio"], 3),
+                    "maxProb": round(speech["max_prob"], 3),
+                    "startEnds": [
+                        [round(st, 3), round(et, 3)] for st, et in speech["start_ends"]
+                    ],
+                }
             )
-            for res_idx, _seg_metadata in enumerate(seg_metadata):
-                responses[_seg_metadata["file_id"]].append(
-                    {
-                        **res[res_idx],
-                        "startTime": round(_seg_metadata["start_time"], 3),
-                        "endTime": round(_seg_metadata["end_time"], 3),
-                    }
+        return responses
+
+    @torch.no_grad()
+    def extract_features(self, audio_signal, prompts, seq_len, seg_metadata, timings=None):
+        with stage(timings, "logMel"):
+            mels, seq_len = self.preprocessor(audio_signal, seq_len)
+            return mels.to(self.device), prompts, seq_len, seg_metadata
+
+    def transcribe_batch(self, audio_signal, prompts, seq_len, seg_metadata, timings=None):
+        return self.decode_batch(
+            *self.extract_features(audio_signal, prompts, seq_len, seg_metadata, timings),
+            timings=timings,
+        )
+
+    def decode_batch(self, mels, prompts, seq_len, seg_metadata, timings=None):
+        """
+        Returns a (seg_metadata, result) pair for every segment in the batch. Packed windows are expanded back
+        into the segments they were built from.
+        """
+
+        res = self.generate_segment_batched(
+            mels, prompts, seq_len, seg_metadata, timings=timings
+        )
+
+        responses = []
+        for _res, _seg_metadata in zip(res, seg_metadata):
+            if "packed_segs" in _seg_metadata:
+                packed_texts = _res.pop("packedTexts")
+                for _packed_metadata, text in zip(
+                    _seg_metadata["packed_metadata"], packed_texts
+                ):
+                    responses.append(
+                        (
+                            _packed_metadata,
+                            {
+                                **_res,
+                                "text": text,
+                                "startTime": round(_packed_metadata["start_time"], 3),
+                                "endTime": round(_packed_metadata["end_time"], 3),
+                            },
+                        )
+                    )
+            else:
+                responses.append(
+                    (
+                        _seg_metadata,
+                        {
+                            **_res,
+                            "startTime": round(_seg_metadata["start_time"], 3),
+                            "endTime": round(_seg_metadata["end_time"], 3),
+                        },
+                    )
                 )
-        return list(chain(*responses))
+
+        return responses
+
+    def transcribe_segments(self, segments, timings=None):
+        """
+        Transcribe segments produced by WhisperDataLoader.get_segments, which may come from different requests.
+        Results are returned in the same order as the given segments.
+        timings is an optional src.timings.Timings, filled with the collate, mel, decoder and tokenizer stages.
+        """
+
+        with stage(timings, "collate", segments=len(segments)):
+            if self.pack_segments:
+                items = list(self.data_loader.pack_segments(segments))
+            else:
+                items = segments
+            batch = self.data_loader.data_collate_fn(items)
+
+        if timings is not None:
+            # Audio seconds actually decoded, against the audio seconds the batch is padded to.
+            timings.add(
+                "collate",
+                windows=len(items),
+                audioSeconds=sum(_[3] for _ in items) / SAMPLE_RATE,
+                paddedAudioSeconds=batch[0].numel() / SAMPLE_RATE,
+            )
+
+        positions = {id(segment[4]): idx for idx, segment in enumerate(segments)}
+        responses = [None] * len(segments)
+        for _seg_metadata, res in self.transcribe_batch(*batch, timings=timings):
+            responses[positions[id(_seg_metadata)]] = res
+
+        return responses
 
 
 class WhisperModelCT2(WhisperModel):
@@ -207,73 +515,171 @@ class WhisperModelCT2(WhisperModel):
         compute_type="float16",
         max_text_token_len=MAX_TEXT_TOKEN_LENGTH,
         asr_options={},
+        default_profile="latency",
         **model_kwargs
     ):
 
+        # Seconds spent in each loading phase.
+        self.load_timings = Timings()
+
+        # The VAD (two TorchScript modules) loads on a worker thread, while CTranslate2 loads the model.
+        vad_loader = None
+        if model_kwargs.get("vad_model") is None:
+            vad_executor = ThreadPoolExecutor(max_workers=1)
+            vad_loader = vad_executor.submit(self.load_vad, model_path, device)
+            vad_executor.shutdown(wait=False)
+
         # Load model
         self.model_path = model_path
-        self.model = ctranslate2.models.Whisper(
-            self.model_path,
-            device=device,
-            device_index=device_index,
-            compute_type=compute_type,
-            intra_threads=cpu_threads,
-            inter_threads=num_workers,
-        )
+        with stage(self.load_timings, "ctranslate2"):
+            self.model = ctranslate2.models.Whisper(
+                self.model_path,
+                device=device,
+                device_index=device_index,
+                compute_type=compute_type,
+                intra_threads=cpu_threads,
+                inter_threads=num_workers,
+            )
 
         # Load tokenizer
-        tokenizer_file = os.path.join(self.model_path, "tokenizer.json")
-        tokenizer = Tokenizer(
-            tokenizers.Tokenizer.from_file(tokenizer_file),
-            self.model.is_multilingual,
-            model_path,
-        )
+        with stage(self.load_timings, "tokenizer"):
+            tokenizer_file = os.path.join(self.model_path, "tokenizer.json")
+            tokenizer = Tokenizer(
+                tokenizers.Tokenizer.from_file(tokenizer_file),
+                self.model.is_multilingual,
+                model_path,
+            )
+
+        # ASR Options. asr_options overrides apply to every profile (see build_asr_profiles).
+        if default_profile not in ASR_PROFILES:
+            raise ValueError(f"Unknown ASR profile: {default_profile}")
+
+        self.asr_profiles = build_asr_profiles(asr_options)
+        self.profile_generate_kwargs = {
+            name: self.get_generate_kwargs(options, max_text_token_len)
+            for name, options in self.asr_profiles.items()
+        }
+        self.default_profile = default_profile
+        self.asr_options = self.asr_profiles[default_profile]
+        self.generate_kwargs = self.profile_generate_kwargs[default_profile]
 
-        # ASR Options
-        self.asr_options = FAST_ASR_OPTIONS
-        self.asr_options.update(asr_options)
+        if self.asr_options["word_timestamps"] and model_kwargs.get("pack_segments"):
+            raise ValueError("Packed segments do not support word timestamps.")
 
-        self.generate_kwargs = {
+        # Word timestamps are aligned with a separate model when word_aligner_model points to one. Otherwise
+        # (e.g. a model name, which would need downloading), the transcription model aligns its own output,
+        # which also lets alignment reuse the encoder output of the decode.
+        self.aligner_model = None
+        if self.asr_options["word_timestamps"]:
+            if os.path.isdir(self.asr_options["word_aligner_model"]):
+                self.aligner_model = ctranslate2.models.Whisper(
+                    self.asr_options["word_aligner_model"],
+                    device=device,
+                    device_index=device_index,
+                    compute_type=compute_type,
+                    intra_threads=cpu_threads,
+                    inter_threads=num_workers,
+                )
+            else:
+                self.aligner_model = self.model
+
+        if vad_loader is not None:
+            # Only the time spent waiting on the VAD adds to the load time.
+            with stage(self.load_timings, "vadWait"):
+                model_kwargs["vad_model"], vad_seconds = vad_loader.result()
+            self.load_timings.add("vad", vad_seconds)
+
+        # Mel filters, speech segmenter and data loader.
+        with stage(self.load_timings, "pipeline"):
+            super().__init__(
+                tokenizer=tokenizer,
+                device=device,
+                device_index=device_index,
+                compute_type=compute_type,
+                max_text_token_len=max_text_token_len,
+                **model_kwargs
+            )
+
+    @staticmethod
+    def load_vad(model_path, device):
+        start_time = time.perf_counter()
+        vad_model = FrameVAD(base_path=model_path, device=device)
+        return vad_model, time.perf_counter() - start_time
+
+    @staticmethod
+    def get_generate_kwargs(asr_options, max_text_token_len):
+        return {
             "max_length": max_text_token_len,
-            "return_scores": self.asr_options["return_scores"],
-            "return_no_speech_prob": self.asr_options["return_no_speech_prob"],
-            "length_penalty": self.asr_options["length_penalty"],
-            "repetition_penalty": self.asr_options["repetition_penalty"],
-            "no_repeat_ngram_size": self.asr_options["no_repeat_ngram_size"],
-            "beam_size": self.asr_options["beam_size"],
-            "patience": self.asr_options["patience"],
-            "suppress_blank": self.asr_options["suppress_blank"],
-            "suppress_tokens": self.asr_options["suppress_tokens"],
+            "return_scores": asr_options["return_scores"],
+            "return_no_speech_prob": asr_options["return_no_speech_prob"],
+            "length_penalty": asr_options["length_penalty"],
+            "repetition_penalty": asr_options["repetition_penalty"],
+            "no_repeat_ngram_size": asr_options["no_repeat_ngram_size"],
+            "beam_size": asr_options["beam_size"],
+            "patience": asr_options["patience"],
+            "suppress_blank": asr_options["suppress_blank"],
+            "suppress_tokens": asr_options["suppress_tokens"],
             "max_initial_timestamp_index": int(
-                round(self.asr_options["max_initial_timestamp"] / TIME_PRECISION)
+                round(asr_options["max_initial_timestamp"] / TIME_PRECISION)
             ),
-            "sampling_temperature": self.asr_options["sampling_temperature"],
+            "sampling_temperature": asr_options["sampling_temperature"],
         }
 
-        super().__init__(
-            tokenizer=tokenizer,
-            device=device,
-            device_index=device_index,
-            compute_type=compute_type,
-            max_text_token_len=max_text_token_len,
-            **model_kwargs
-        )
+    def profile_name(self, profile=None):
+        if profile is None:
+            profile = self.default_profile
+        if profile not in self.asr_profiles:
+            raise ValueError(f"Unknown ASR profile: {profile}")
+
+        return profile
+
+    def get_profile(self, profile=None):
+        profile = self.profile_name(profile)
+        return self.asr_profiles[profile], self.profile_generate_kwargs[profile]
 
-    def update_generation_kwargs(self, params={}):
-        self.generate_kwargs.update(params)
+    def update_generation_kwargs(self, params={}, profile=None):
+        self.get_profile(profile)[1].update(params)
 
         if "max_text_token_len" in params:
             self.update_params(
                 params={"max_text_token_len": params["max_text_token_len"]}
             )
 
+    def to_storage_view(self, features):
+        if self.device == "cpu":
+            features = np.ascontiguousarray(features.detach().numpy())
+        else:
+            features = features.contiguous()
+
+        return ctranslate2.StorageView.from_array(features)
+
     def encode(self, features):
         """
-        [Not Used]
+        Run the encoder once per batch. Its output can be passed to generate and align in place of the features,
+        which then skip the encoder.
+        """
+
+        return self.model.encode(self.to_storage_view(features), to_cpu=False)
+
+    def select_features(self, features, indices):
+        """
+        The given batch items of features (mel features, or encoder output) as a StorageView.
         """
 
-        features = ctranslate2.StorageView.from_array(features.contiguous())
-        return self.model.encode(features)
+        indices = list(indices)
+        if isinstance(features, ctranslate2.StorageView):
+            if indices == list(range(features.shape[0])):
+                return features
+
+            if features.device == "cpu":
+                features = np.asarray(features)
+            else:
+                features = torch.as_tensor(features)
+
+        if isinstance(features, torch.Tensor):
+            return self.to_storage_view(features[indices])
+
+        return ctranslate2.StorageView.from_array(np.ascontiguousarray(features[indices]))
 
     def assign_word_timings(self, alignments, text_token_probs, words, word_tokens):
         text_indices = np.array([pair[0] for pair in alignments])
@@ -302,6 +708,38 @@ class WhisperModelCT2(WhisperModel):
             for word, start, end, prob in zip(words, start_times, end_times, word_probs)
         ]
 
+    def split_packed_tokens(self, tokens, packed_segs):
+        """
+        Split the timestamped tokens of a packed window back into one text per packed segment.
+        Each timestamped span is assigned to the segment containing its midpoint (or the nearest one).
+        """
+
+        spans, span_tokens, span_start = [], [], 0.0
+        for token in tokens:
+            if token < self.tokenizer.eot:
+                span_tokens.append(token)
+            elif token >= self.tokenizer.timestamp_begin:
+                time = (token - self.tokenizer.timestamp_begin) * TIME_PRECISION
+                if span_tokens:
+                    spans.append((span_start, time, span_tokens))
+                    span_tokens = []
+                span_start = time
+        if span_tokens:
+            spans.append((span_start, packed_segs[-1][1], span_tokens))
+
+        texts = [[] for _ in packed_segs]
+        for start, end, _span_tokens in spans:
+            midpoint = (start + end) / 2
+            distances = [
+                max(st - self.pack_gap / 2 - midpoint, midpoint - et - self.pack_gap / 2, 0.0)
+                for st, et in packed_segs
+            ]
+            texts[int(np.argmin(distances))].append(
+                self.tokenizer.decode(_span_tokens).strip()
+            )
+
+        return [" ".join(_) for _ in texts]
+
     def align_words(
         self, features, texts, text_tokens, sot_seqs, seq_lens, seg_metadata
     ):
@@ -321,7 +759,7 @@ class WhisperModelCT2(WhisperModel):
         token_alignments = [[] for _ in seg_metadata]
         for start_seq, req_idx in start_seq_wise_req.items():
             res = self.aligner_model.align(
-                ctranslate2.StorageView.from_array(features[req_idx]),
+                self.select_features(features, req_idx),
                 start_sequence=list(start_seq),
                 text_tokens=[text_tokens[_] for _ in req_idx],
                 num_frames=list(seq_lens[req_idx].detach().cpu().numpy()),
@@ -360,41 +798,202 @@ class WhisperModelCT2(WhisperModel):
 
         return word_timings
 
-    def generate_segment_batched(self, features, prompts, seq_lens, seg_metadata):
+    def detect_no_speech(self, encoder_output, prompts):
+        """
+        Single step decode, for the no speech probability of each segment.
+        """
 
-        if self.device == "cpu":
-            features = np.ascontiguousarray(features.detach().numpy())
-        else:
-            features = features.contiguous()
+        # Greedy and without sampling, whatever the profile decodes with: only the first step's probabilities are used.
+        return [
+            r.no_speech_prob
+            for r in self.model.generate(
+                encoder_output,
+                prompts,
+                max_length=1,
+                beam_size=1,
+                num_hypotheses=1,
+                sampling_topk=1,
+                return_no_speech_prob=True,
+            )
+        ]
 
-        result = self.model.generate(
-            ctranslate2.StorageView.from_array(features),
-            prompts,
-            **self.generate_kwargs
-        )
+    def no_speech_result(self, no_speech_prob, seg_metadata, asr_options):
+        response = {"text": "", "noSpeechProb": no_speech_prob, "noSpeech": True}
+        if "packed_segs" in seg_metadata:
+            response["packedTexts"] = ["" for _ in seg_metadata["packed_segs"]]
+        if asr_options["word_timestamps"]:
+            response["word_timestamps"] = []
+        return response
+
+    def generate_segment_batched(
+        self, features, prompts, seq_lens, seg_metadata, timings=None
+    ):
+        # Batches never mix profiles (see BatchScheduler.next_batch).
+        asr_options, generate_kwargs = self.get_profile(seg_metadata[0].get("profile"))
+
+        with stage(timings, "encode"):
+            encoder_output = self.encode(features)
+        if not asr_options["no_speech_early_exit"]:
+            return self.decode_segments(
+                features,
+                encoder_output,
+                prompts,
+                seq_lens,
+                seg_metadata,
+                asr_options,
+                generate_kwargs,
+                timings,
+            )
+
+        # Two phases: segments that are likely silent (mostly VAD false positives) are flagged after a single
+        # decode step, and only the others are fully decoded.
+        response = [None] * len(prompts)
+        decode_idx = []
+        with stage(timings, "noSpeech", segments=len(prompts)):
+            no_speech_probs = self.detect_no_speech(encoder_output, prompts)
+        for idx, no_speech_prob in enumerate(no_speech_probs):
+            if no_speech_prob < asr_options["no_speech_threshold"]:
+                decode_idx.append(idx)
+            else:
+                response[idx] = self.no_speech_result(
+                    no_speech_prob, seg_metadata[idx], asr_options
+                )
+
+        if decode_idx:
+            decoded = self.decode_segments(
+                features[decode_idx],
+                self.select_features(encoder_output, decode_idx),
+                [prompts[_] for _ in decode_idx],
+                seq_lens[decode_idx],
+                [seg_metadata[_] for _ in decode_idx],
+                asr_options,
+                generate_kwargs,
+                timings,
+            )
+            for idx, _response in zip(decode_idx, decoded):
+                response[idx] = _response
+
+        return response
+
+    def token_budgets(self, seq_lens, asr_options, generate_kwargs):
+        """
+        Decode budget of each segment: a floor plus max_tokens_per_second of audio, up to max_length.
+        seq_lens are in mel frames.
+        """
 
-        texts = self.tokenizer.decode_batch([x.sequences_ids[0] for x in result])
+        max_length = generate_kwargs["max_length"]
+        if asr_options["max_tokens_per_second"] is None:
+            return [max_length for _ in seq_lens]
+
+        return [
+            min(
+                max_length,
+                asr_options["min_token_budget"]
+                + int(
+                    np.ceil(
+                        asr_options["max_tokens_per_second"]
+                        * seq_len
+                        * HOP_LENGTH
+                        / SAMPLE_RATE
+                    )
+                ),
+            )
+            for seq_len in seq_lens.tolist()
+        ]
+
+    def decode_segments(
+        self,
+        features,
+        encoder_output,
+        prompts,
+        seq_lens,
+        seg_metadata,
+        asr_options,
+        generate_kwargs,
+        timings=None,
+    ):
+        # CTranslate2 only takes a max_length per generate call (and has no per step callback to stop a sequence
+        # early), so the batch is decoded in budget groups (see budget_groups), and each sequence is cut to its own
+        # budget afterwards.
+        budgets = self.token_budgets(seq_lens, asr_options, generate_kwargs)
+        groups = budget_groups(budgets)
+        result = [None] * len(prompts)
+        with stage(timings, "generate", segments=len(prompts), calls=len(groups)):
+            for group in groups:
+                group_result = self.model.generate(
+                    self.select_features(encoder_output, group),
+                    [prompts[_] for _ in group],
+                    **{**generate_kwargs, "max_length": max(budgets[_] for _ in group)},
+                )
+                for idx, r in zip(group, group_result):
+                    result[idx] = r
+
+        # Repetition loops are only found once decoding is done: cutting them cleans up the text, while the time
+        # they cost is bounded by the budgets above. Sequences that reached their budget were most likely cut short,
+        # and are flagged as truncated.
+        tokens, loops, truncated = [], [], []
+        for r, budget in zip(result, budgets):
+            truncated.append(len(r.sequences_ids[0]) >= budget)
+            _tokens = r.sequences_ids[0][:budget]
+            cut = find_repetition_loop(
+                _tokens,
+                max_ngram=asr_options["repetition_loop_max_ngram"],
+                min_repeats=asr_options["repetition_loop_min_repeats"],
+                min_tokens=asr_options["repetition_loop_min_tokens"],
+            )
+            tokens.append(_tokens if cut is None else _tokens[:cut])
+            loops.append(cut is not None)
+
+        if timings is not None:
+            timings.add(
+                "generate",
+                tokens=sum(len(r.sequences_ids[0]) for r in result),
+                keptTokens=sum(map(len, tokens)),
+            )
+
+        with stage(timings, "tokenizerDecode"):
+            texts = self.tokenizer.decode_batch(tokens)
+            packed_texts = [
+                self.split_packed_tokens(_tokens, _seg_metadata["packed_segs"])
+                if "packed_segs" in _seg_metadata
+                else None
+                for _tokens, _seg_metadata in zip(tokens, seg_metadata)
+            ]
 
         response = []
         for idx, r in enumerate(result):
             response.append({"text": texts[idx].strip()})
 
-            if self.generate_kwargs["return_scores"]:
+            if loops[idx]:
+                response[-1]["repetitionLoop"] = True
+
+            if truncated[idx]:
+                response[-1]["truncated"] = True
+
+            if packed_texts[idx] is not None:
+                response[-1]["packedTexts"] = packed_texts[idx]
+
+            if generate_kwargs["return_scores"]:
                 seq_len = len(r.sequences_ids[0])
                 cum_logprob = r.scores[0] * (
-                    seq_len ** self.generate_kwargs["length_penalty"]
+                    seq_len ** generate_kwargs["length_penalty"]
                 )
                 response[-1]["avgLogProb"] = cum_logprob / (seq_len + 1)
 
-            if self.generate_kwargs["return_no_speech_prob"]:
+            if generate_kwargs["return_no_speech_prob"]:
                 response[-1]["noSpeechProb"] = r.no_speech_prob
 
-        if self.asr_options["word_timestamps"]:
-            text_tokens = [x.sequences_ids[0] + [self.tokenizer.eot] for x in result]
+        if asr_options["word_timestamps"]:
+            text_tokens = [_tokens + [self.tokenizer.eot] for _tokens in tokens]
             sot_seqs = [tuple(_[-4:]) for _ in prompts]
-            word_timings = self.align_words(
-                features, texts, text_tokens, sot_seqs, seq_lens, seg_metadata
-            )
+            # A separate aligner model has its own encoder, so it needs the mel features instead.
+            if self.aligner_model is not self.model:
+                encoder_output = features
+
+            with stage(timings, "alignWords"):
+                word_timings = self.align_words(
+                    encoder_output, texts, text_tokens, sot_seqs, seq_lens, seg_metadata
+                )
 
             for _response, _word_timings in zip(response, word_timings):
                 _response["word_timestamps"] = _word_timings
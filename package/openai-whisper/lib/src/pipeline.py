@@ -0,0 +1,136 @@
+# Runs the stages of a data pipeline on worker threads, connected by bounded queues.
+#
+# The heavy parts of every stage (TorchScript VAD, torch STFT, CTranslate2 generate) release the GIL,
+# so the front-end stages of upcoming batches overlap with the decoding of the current one.
+
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class StageTiming:
+    def __init__(self):
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.items = 0
+
+    def to_dict(self):
+        return {
+            "busySeconds": round(self.busy_seconds, 6),
+            "waitSeconds": round(self.wait_seconds, 6),
+            "items": self.items,
+        }
+
+
+def _put(output, item, stop, timing):
+    start_time = time.perf_counter()
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=0.1)
+            break
+        except queue.Full:
+            pass
+    timing.wait_seconds += time.perf_counter() - start_time
+
+
+def _get(input, stop, timing):
+    start_time = time.perf_counter()
+    item = _DONE
+    while not stop.is_set():
+        try:
+            item = input.get(timeout=0.1)
+            break
+        except queue.Empty:
+            pass
+    timing.wait_seconds += time.perf_counter() - start_time
+    return item
+
+
+def _produce(source, output, stop, timing):
+    try:
+        items = iter(source)
+        while not stop.is_set():
+            start_time = time.perf_counter()
+            item = next(items, _DONE)
+            timing.busy_seconds += time.perf_counter() - start_time
+            if item is _DONE:
+                break
+            timing.items += 1
+            _put(output, item, stop, timing)
+        _put(output, _DONE, stop, timing)
+    except BaseException as e:
+        _put(output, _Failure(e), stop, timing)
+
+
+def _map(f, input, output, stop, timing):
+    while not stop.is_set():
+        item = _get(input, stop, timing)
+        if item is _DONE or isinstance(item, _Failure):
+            _put(output, item, stop, timing)
+            return
+        try:
+            start_time = time.perf_counter()
+            item = f(item)
+            timing.busy_seconds += time.perf_counter() - start_time
+            timing.items += 1
+        except BaseException as e:
+            item = _Failure(e)
+        _put(output, item, stop, timing)
+
+
+def run_pipeline(source, stages, max_queue_size=2, timings=None):
+    """
+    Iterate over source on a worker thread, and pass each item through stages (a list of (name, f) pairs),
+    each running on its own worker thread. Outputs of the last stage are yielded on the calling thread.
+
+    source is given as a (name, iterable) pair. Queues between stages hold at most max_queue_size items,
+    which bounds how far ahead of the consumer the pipeline runs. When timings is a dict, it is filled with a
+    StageTiming per stage: time spent working, and time spent waiting on the neighbouring stages.
+    """
+
+    if timings is None:
+        timings = {}
+
+    stop = threading.Event()
+    source_name, source_items = source
+    queues = [queue.Queue(maxsize=max_queue_size) for _ in range(len(stages) + 1)]
+
+    timings[source_name] = StageTiming()
+    threads = [
+        threading.Thread(
+            target=_produce,
+            args=(source_items, queues[0], stop, timings[source_name]),
+            daemon=True,
+        )
+    ]
+    for idx, (name, f) in enumerate(stages):
+        timings[name] = StageTiming()
+        threads.append(
+            threading.Thread(
+                target=_map,
+                args=(f, queues[idx], queues[idx + 1], stop, timings[name]),
+                daemon=True,
+            )
+        )
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+    finally:
+        # Unblocks the worker threads if the consumer stops early.
+        stop.set()
@@ -0,0 +1,90 @@
+# On-demand profiling of a running worker.
+#
+# Restarting a worker with a profiler attached reloads the model, which tends to hide the latency spikes being
+# chased. Instead, a control message starts a capture for the next N requests or T seconds, with either
+# torch.profiler (a Chrome trace, with the pipeline stages labelled through src/timings.stage) or cProfile (a pstats
+# file). Nothing is hooked while no capture is running.
+
+from src import timings
+
+import cProfile
+import os
+import time
+import torch
+
+MODES = ("torch", "cprofile")
+
+
+class ProfilingSession:
+    def __init__(self, mode="torch", requests=None, seconds=None, directory="."):
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode: {mode}")
+
+        # Without any limit, only the next request is captured.
+        if requests is None and seconds is None:
+            requests = 1
+
+        self.mode = mode
+        self.max_requests = requests
+        self.max_seconds = seconds
+        self.requests = 0
+
+        extension = "json" if mode == "torch" else "prof"
+        timestamp = time.strftime("%Y%m%d-%H%M%S") + f"-{int(time.time() * 1000) % 1000:03d}"
+        self.path = os.path.abspath(
+            os.path.join(directory, f"whisper-{mode}-{timestamp}.{extension}")
+        )
+
+        self.profiler = None
+        self.start_time = None
+
+    def start(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if self.mode == "torch":
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities)
+            self.profiler.start()
+            timings.record_function = torch.profiler.record_function
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start_time = time.monotonic()
+
+    def remaining(self):
+        """
+        Seconds until the capture is due to stop, or None if it only stops after a number of requests.
+        """
+
+        if self.max_seconds is None:
+            return None
+        return max(0.0, self.start_time + self.max_seconds - time.monotonic())
+
+    @property
+    def done(self):
+        if self.max_requests is not None and self.requests >= self.max_requests:
+            return True
+        return self.remaining() == 0.0
+
+    def stop(self):
+        """
+        Stop the capture, write it to self.path, and return a summary of it.
+        """
+
+        seconds = time.monotonic() - self.start_time
+        if self.mode == "torch":
+            timings.record_function = None
+            self.profiler.stop()
+            self.profiler.export_chrome_trace(self.path)
+        else:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.path)
+        self.profiler = None
+
+        return {
+            "path": self.path,
+            "mode": self.mode,
+            "requests": self.requests,
+            "seconds": round(seconds, 3),
+        }
@@ -0,0 +1,155 @@
+# Wire format for the stdin/stdout channel between the host and the whisper worker.
+#
+# The first line the worker reads is the model path, or a JSON config such as {"modelPath": "...", "warmup": true}.
+# The worker answers it with a single line, "True" or "False" (whether CUDA is used), once it is ready.
+#
+# Two encodings are accepted on stdin, and can be mixed freely:
+#
+#   JSON mode: one UTF-8 JSON object per line. Each clip in "samplesBatch" is base64 encoded 16-bit PCM.
+#
+#   Binary mode: a length-prefixed frame, laid out as follows (all integers are little-endian):
+#       1 byte   FRAME_MARKER
+#       4 bytes  header length, in bytes
+#       N bytes  UTF-8 JSON header, e.g. {"requestId": 1, "language": "en", "clipLengths": [32000, 16000]}
+#       M bytes  raw 16-bit PCM for every clip, back to back. M is the sum of "clipLengths" (in bytes).
+#
+# Responses are written in the same encoding as the request they answer. A binary response is the same frame
+# without a payload, i.e. the marker, the body length, and the JSON body.
+# Messages that can't be read (malformed JSON, invalid base64, odd clip lengths, ...) are answered with
+# {"exception": ...}, carrying their "requestId" if it could be parsed.
+#
+# Besides "samplesBatch", a request may hold "requestId", "language", "speechTimestamps", "vad", "profile",
+# "priority" ("high", "normal" or "low"), "deadlineMs" and "timings". Requests with "timings" set are answered with a
+# per-stage latency breakdown (see src/timings.py) under "timings". Control messages carry no audio:
+#   {"cancel": <requestId>}   Drop a request. It is answered with {"cancelled": true}.
+#   {"cacheStats": true}      Transcription cache counters.
+#   {"queueStats": true}      Scheduler queue counters.
+#   {"workerStats": true}     Error, restart and recovery time counters, and the seconds spent in each startup phase.
+#   {"stats": true}           Rolling throughput, batch fill, queue depth, speech ratio and latency percentiles
+#                             (see src/stats.py), along with all of the above. Answered without waiting for the
+#                             running batch.
+#   {"profiling": {"mode": "torch" | "cprofile", "requests": N, "seconds": T}}
+#                             Profile the worker for the next N requests or T seconds (the next request by default).
+#                             Answered once the capture is done, with the path its trace was written to.
+
+import base64
+import json
+import struct
+import time
+
+# A JSON line can never start with a null byte, which lets us tell both encodings apart from the first byte.
+FRAME_MARKER = b"\x00"
+
+_LENGTH = struct.Struct("<I")
+
+
+class ProtocolError(Exception):
+    """
+    A message that couldn't be read. request_id and binary tell how to answer it, as far as they are known.
+    """
+
+    def __init__(self, message, request_id=None, binary=False):
+        super().__init__(message)
+        self.request_id = request_id
+        self.binary = binary
+
+
+def _read_exactly(stream, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    read = 0
+    while read < size:
+        n = stream.readinto(view[read:])
+        if not n:
+            raise ProtocolError(
+                f"Unexpected end of stream. Expected {size} bytes, received {read}.", binary=True
+            )
+        read += n
+    return buffer
+
+
+def read_frame(stream):
+    """
+    Read a binary frame (after its marker byte) and return the parsed request.
+    Clips in "samplesBatch" are memoryviews over a single payload buffer, so no copies are made.
+    """
+
+    (header_length,) = _LENGTH.unpack(_read_exactly(stream, _LENGTH.size))
+    request = _parse_json(_read_exactly(stream, header_length), binary=True)
+    clip_lengths = request.pop("clipLengths", [])
+    # The payload is read before the request is validated, so that the next frame still starts where expected.
+    payload = memoryview(_read_exactly(stream, sum(clip_lengths)))
+    if any(length % 2 for length in clip_lengths):
+        raise ProtocolError(
+            "Clip lengths must be a multiple of 2 bytes (16-bit PCM).",
+            request_id=request.get("requestId"),
+            binary=True,
+        )
+
+    samples_batch = []
+    offset = 0
+    for length in clip_lengths:
+        samples_batch.append(payload[offset : offset + length])
+        offset += length
+    request["samplesBatch"] = samples_batch
+
+    return request
+
+
+def _parse_json(data, binary=False):
+    try:
+        message = json.loads(data.decode("utf-8-sig"))
+    except ValueError as e:
+        raise ProtocolError(f"Invalid JSON: {e}", binary=binary) from e
+    if not isinstance(message, dict):
+        raise ProtocolError("Messages must be JSON objects.", binary=binary)
+    return message
+
+
+def read_message(stream):
+    """
+    Read the next request from the stream.
+    Returns a tuple of the request and whether it was sent in binary mode, or None once the stream is closed.
+    Messages that can't be read raise a ProtocolError, holding their request id if it could be parsed.
+    The seconds spent reading and decoding the request, once its first byte arrived, are stored in its
+    "decodeSeconds" field.
+    """
+
+    while True:
+        marker = stream.read(1)
+        if not marker:
+            return None
+        start_time = time.perf_counter()
+        if marker == FRAME_MARKER:
+            request, binary = read_frame(stream), True
+            break
+
+        # A blank line is a complete (empty) line already, reading on would swallow the next message.
+        if marker == b"\n":
+            continue
+
+        line = (marker + stream.readline()).strip()
+        if line:
+            request, binary = _parse_json(line), False
+            if "samplesBatch" in request:
+                try:
+                    request["samplesBatch"] = [
+                        base64.b64decode(sample) for sample in request["samplesBatch"]
+                    ]
+                except (TypeError, ValueError) as e:
+                    raise ProtocolError(
+                        f"Invalid base64 in samplesBatch: {e}", request_id=request.get("requestId")
+                    ) from e
+            break
+
+    request["decodeSeconds"] = time.perf_counter() - start_time
+    return request, binary
+
+
+def write_message(stream, message, binary=False):
+    body = json.dumps(message).encode("utf-8")
+    if binary:
+        stream.write(FRAME_MARKER + _LENGTH.pack(len(body)) + body)
+    else:
+        stream.write(body + b"\n")
+    stream.flush()
@@ -0,0 +1,530 @@
+# Dynamic micro-batching across in-flight requests.
+#
+# Each request usually holds one or two short clips, which leaves generate_segment_batched running far below its
+# batch size. The scheduler pools the speech segments of every in-flight request, and runs them through a single
+# batch once the batch is full, or once the oldest pending segment has waited for the configured window.
+#
+# When more segments are pending than fit in a batch, the batch is built around the oldest pending segment, and
+# filled with the segments closest to it in length. The decoder runs until the longest sequence of a batch
+# finishes, so batching segments of similar length keeps it from decoding padding.
+#
+# Segments decoded with different ASR profiles (i.e. different generate options) never share a batch.
+#
+# Requests belong to a priority class, and segments of a higher class always run first. Requests can carry a
+# deadline, and be cancelled. The queued segments of cancelled or expired requests are dropped before they are
+# decoded.
+#
+# A batch that fails is retried one request at a time, so that only the request at fault fails. Fatal errors
+# (see src/errors.py) are raised to the caller instead.
+#
+# Requests can ask for a breakdown of their latency (see src/timings.py). Stages that run once per batch (collate,
+# mel, decoder, ...) are shared by every request of the batch, so each of them is attributed the whole batch.
+# Aggregated counters across requests (see src/stats.py) are recorded as requests and batches go through.
+
+from collections import deque
+from src.audio import to_audio_signal
+from src.errors import is_fatal_error
+from src.model import fix_batch_param, no_speech_response
+from src.timings import Timings, stage
+from whisper_s2t.configs import SAMPLE_RATE
+
+import time
+import traceback
+
+# Priority classes, from highest to lowest.
+PRIORITIES = ("high", "normal", "low")
+
+
+class TranscriptionRequest:
+    def __init__(
+        self,
+        request_id,
+        samples_batch,
+        lang_codes=None,
+        tasks=None,
+        initial_prompts=None,
+        start_ends=None,
+        binary=False,
+        profile=None,
+        priority="normal",
+        deadline_ms=None,
+        timings=False,
+        receive_time=None,
+    ):
+        self.request_id = request_id
+        self.samples_batch = samples_batch
+        self.lang_codes = fix_batch_param(lang_codes, "en", len(samples_batch))
+        self.tasks = fix_batch_param(tasks, "transcribe", len(samples_batch))
+        self.initial_prompts = fix_batch_param(
+            initial_prompts, None, len(samples_batch)
+        )
+
+        # Speech timestamps per clip, when the host already ran its own VAD.
+        self.start_ends = start_ends
+
+        # ASR profile to decode with, or None for the model's default.
+        self.profile = profile
+
+        # Encoding the response should be written in.
+        self.binary = binary
+
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        self.priority = priority
+
+        # time.monotonic() when the request was received, which its latency and deadline count from. Requests can
+        # wait in main.py's inbox for the running batch, so main.py passes in when it read them.
+        self.receive_time = time.monotonic() if receive_time is None else receive_time
+        self.latency = None
+
+        # Requests that aren't done by their deadline (in milliseconds after they were received) are dropped.
+        self.deadline = None
+        if deadline_ms is not None:
+            self.deadline = self.receive_time + deadline_ms / 1000
+
+        # None while the request is running, or "cancelled"/"expired"/"failed" once it has been dropped.
+        self.status = None
+        self.error = None
+
+        self.remaining = 0
+        self.results = [[] for _ in samples_batch]
+
+        # Cache keys of the clips that missed the transcription cache, by file_id.
+        self.cache_keys = {}
+
+        # Latency breakdown returned along with the response, when asked for.
+        self.timings = Timings() if timings else None
+
+    @property
+    def done(self):
+        return self.remaining == 0
+
+    @property
+    def audio_seconds(self):
+        # 16-bit PCM, hence the 2 bytes per sample.
+        return sum(map(len, self.samples_batch)) / 2 / SAMPLE_RATE
+
+    def add_result(self, file_id, seg_idx, result):
+        self.results[file_id].append((seg_idx, result))
+        self.remaining -= 1
+
+    def file_response(self, file_id):
+        if self.results[file_id]:
+            return [result for _, result in sorted(self.results[file_id], key=lambda _: _[0])]
+
+        # 16-bit PCM, hence the 2 bytes per sample.
+        return [no_speech_response(len(self.samples_batch[file_id]) / 2 / SAMPLE_RATE)]
+
+    def response(self):
+        response = []
+        for file_id in range(len(self.samples_batch)):
+            response.extend(self.file_response(file_id))
+        return response
+
+    def message(self):
+        if self.status == "cancelled":
+            message = {"cancelled": True}
+        elif self.status == "expired":
+            message = {"expired": True}
+        elif self.status == "failed":
+            message = {"exception": self.error}
+        else:
+            message = {"response": self.response()}
+
+        if self.timings is not None:
+            message["timings"] = self.timings.to_dict()
+        return message
+
+    def finish(self):
+        self.latency = time.monotonic() - self.receive_time
+        if self.timings is not None:
+            self.timings.add("total", self.latency)
+
+
+class BatchScheduler:
+    def __init__(
+        self,
+        model,
+        batch_size=32,
+        max_wait=0.005,
+        bucket_window=None,
+        cache=None,
+        metrics=None,
+    ):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+
+        # How many of the oldest pending segments are considered for each batch. None batches in arrival order.
+        self.bucket_window = bucket_window
+
+        # Optional TranscriptionCache. Cached clips skip the VAD and the decoder entirely.
+        self.cache = cache
+
+        # Optional WorkerStats, fed with every finished request and every batch.
+        self.metrics = metrics
+
+        # Pending segments per priority class, in arrival order: (request, seg_idx, segment, arrival_time)
+        self.pending = {priority: deque() for priority in PRIORITIES}
+
+        # Requests that have been submitted, but not completed yet.
+        self.requests = []
+
+        self.completed = 0
+        self.cancelled = 0
+        self.expired = 0
+        self.failed = 0
+        self.deadline_misses = 0
+        self.queue_waits = 0
+        self.queue_wait_seconds = 0.0
+        self.max_queue_wait_seconds = 0.0
+
+    def submit(self, request):
+        """
+        Segment the request's audio and queue its segments for the next batches.
+        Returns the requests completed by this call (a request without any segments completes immediately).
+        """
+
+        # Unknown profiles are rejected here, rather than failing every request of a batch later on. None is resolved
+        # to the default profile's name, so that segments asking for it by name can share batches with the others.
+        request.profile = self.model.profile_name(request.profile)
+
+        with stage(request.timings, "cacheLookup"):
+            file_ids = self.lookup(request)
+        start_ends = request.start_ends
+        if start_ends is not None:
+            start_ends = [start_ends[_] for _ in file_ids]
+
+        def audio_signals():
+            for file_id in file_ids:
+                with stage(request.timings, "toAudioSignal", clips=1):
+                    audio_signal = to_audio_signal(request.samples_batch[file_id])
+                yield audio_signal
+
+        segments = self.model.data_loader.get_segments(
+            audio_signals(),
+            [request.lang_codes[_] for _ in file_ids],
+            [request.tasks[_] for _ in file_ids],
+            [request.initial_prompts[_] for _ in file_ids],
+            start_ends=start_ends,
+            profile=request.profile,
+            timings=request.timings,
+        )
+        speech_samples = 0
+        try:
+            for seg_idx, segment in enumerate(segments):
+                # Segments are numbered among the clips that were segmented, rather than the whole request.
+                segment[4]["file_id"] = file_ids[segment[4]["file_id"]]
+                self.pending[request.priority].append(
+                    (request, seg_idx, segment, time.monotonic())
+                )
+                request.remaining += 1
+                speech_samples += segment[3]
+        except Exception:
+            # Segments queued before the error would otherwise be decoded for nothing.
+            queue = self.pending[request.priority]
+            self.pending[request.priority] = deque(_ for _ in queue if _[0] is not request)
+            raise
+
+        if self.metrics is not None and file_ids:
+            self.metrics.record_segmentation(
+                sum(len(request.samples_batch[_]) for _ in file_ids) / 2 / SAMPLE_RATE,
+                speech_samples / SAMPLE_RATE,
+            )
+
+        if request.done:
+            self.store(request)
+            self.completed += 1
+            self.finish(request)
+            return [request]
+
+        self.requests.append(request)
+        return []
+
+    def lookup(self, request):
+        """
+        Fill in the results of the request's cached clips, and return the file_ids of the others.
+        """
+
+        if self.cache is None:
+            return list(range(len(request.samples_batch)))
+
+        options, _ = self.model.get_profile(request.profile)
+        file_ids = []
+        for file_id, samples in enumerate(request.samples_batch):
+            key = self.cache.key(
+                samples,
+                lang=request.lang_codes[file_id],
+                task=request.tasks[file_id],
+                initial_prompt=request.initial_prompts[file_id],
+                start_ends=None if request.start_ends is None else request.start_ends[file_id],
+                options=options,
+            )
+            results = self.cache.get(key)
+            if results is None:
+                request.cache_keys[file_id] = key
+                file_ids.append(file_id)
+            else:
+                request.results[file_id] = list(enumerate(results))
+
+        return file_ids
+
+    def store(self, request):
+        for file_id, key in request.cache_keys.items():
+            self.cache.put(key, request.file_response(file_id))
+
+    def finish(self, request):
+        request.finish()
+        if self.metrics is not None:
+            self.metrics.record_request(
+                request.latency, request.audio_seconds, request.status
+            )
+
+    def pending_count(self):
+        return sum(map(len, self.pending.values()))
+
+    def drop(self, request, status):
+        """
+        Drop a request and its queued segments, without decoding them.
+        """
+
+        request.status = status
+        self.finish(request)
+        queue = self.pending[request.priority]
+        self.pending[request.priority] = deque(_ for _ in queue if _[0] is not request)
+        if request in self.requests:
+            self.requests.remove(request)
+
+    def cancel(self, request_id):
+        """
+        Cancel the in-flight requests with the given id, and return them.
+        """
+
+        cancelled = [_ for _ in self.requests if _.request_id == request_id]
+        for request in cancelled:
+            self.drop(request, "cancelled")
+            self.cancelled += 1
+        return cancelled
+
+    def fail(self, request, error):
+        request.error = error
+        self.drop(request, "failed")
+        self.failed += 1
+
+    def fail_all(self, error):
+        """
+        Fail every in-flight request (e.g. before the model is reloaded), and return them.
+        """
+
+        failed = list(self.requests)
+        for request in failed:
+            self.fail(request, error)
+        return failed
+
+    def expire(self):
+        """
+        Drop the in-flight requests that are past their deadline, and return them.
+        """
+
+        now = time.monotonic()
+        expired = [
+            _ for _ in self.requests if _.deadline is not None and now > _.deadline
+        ]
+        for request in expired:
+            self.drop(request, "expired")
+            self.expired += 1
+        return expired
+
+    def timeout(self):
+        """
+        Seconds until the next batch is due, or None if there is nothing to run.
+        """
+
+        queues = [_ for _ in self.pending.values() if _]
+        if not queues:
+            return None
+        if sum(map(len, queues)) >= self.batch_size:
+            return 0.0
+        oldest = min(_[0][3] for _ in queues)
+        return max(0.0, oldest + self.max_wait - time.monotonic())
+
+    def next_batch(self):
+        """
+        Take the next batch of segments off the pending queues.
+        """
+
+        # Segments of the highest priority class with pending segments.
+        queue = next((_ for _ in self.pending.values() if _), None)
+        if queue is None:
+            return []
+
+        # Only segments sharing the oldest segment's profile are considered: the first bucket_window of them,
+        # or the first batch of them without bucketing.
+        profile = queue[0][2][4].get("profile")
+        window_size = max(self.bucket_window or 0, self.batch_size)
+        window, skipped, position = [], [], 0
+        while queue and len(window) < window_size:
+            item = queue.popleft()
+            if item[2][4].get("profile") == profile:
+                window.append((position, item))
+            else:
+                skipped.append((position, item))
+            position += 1
+
+        if len(window) > self.batch_size:
+            # The oldest segment always makes it in, so that long segments can't starve.
+            seq_len = window[0][1][2][3]
+            ranked = sorted(
+                range(1, len(window)),
+                key=lambda idx: abs(window[idx][1][2][3] - seq_len),
+            )
+            selected = {0, *ranked[: self.batch_size - 1]}
+        else:
+            selected = set(range(len(window)))
+
+        # Segments left out go back to the front of the queue, in their original order.
+        left_out = skipped + [_ for idx, _ in enumerate(window) if idx not in selected]
+        queue.extendleft(reversed([item for _, item in sorted(left_out, key=lambda _: _[0])]))
+        return [item for idx, (_, item) in enumerate(window) if idx in selected]
+
+    def run_batch(self):
+        """
+        Transcribe the next batch of pending segments, and return the requests it completed.
+        Requests that expired in the meantime are returned as well.
+        """
+
+        expired = self.expire()
+        queue_depth = self.pending_count()
+        batch = self.next_batch()
+        if not batch:
+            return expired
+
+        try:
+            return expired + self.process_batch(batch, queue_depth)
+        except Exception as e:
+            if is_fatal_error(e):
+                raise
+            return expired + self.fail_batch(batch, traceback.format_exc())
+
+    def process_batch(self, batch, queue_depth):
+        if self.metrics is not None:
+            self.metrics.record_batch(
+                len(batch), self.batch_size, [_[2][3] for _ in batch], queue_depth
+            )
+
+        start_time = time.monotonic()
+        for _, _, _, arrival_time in batch:
+            self.queue_waits += 1
+            self.queue_wait_seconds += start_time - arrival_time
+            self.max_queue_wait_seconds = max(
+                self.max_queue_wait_seconds, start_time - arrival_time
+            )
+
+        # Requests that asked for timings share the batch's.
+        timings = None
+        if any(_[0].timings is not None for _ in batch):
+            timings = Timings()
+
+        try:
+            with stage(timings, "batch"):
+                results = self.model.transcribe_segments(
+                    [_[2] for _ in batch], timings=timings
+                )
+        except Exception as e:
+            if is_fatal_error(e):
+                raise
+            self.attribute(batch, timings, start_time)
+            return self.isolate(batch)
+
+        self.attribute(batch, timings, start_time)
+        return self.add_results(batch, results)
+
+    def fail_batch(self, batch, error):
+        """
+        Fail the requests of a batch that went wrong outside of decoding (e.g. while storing its results in the
+        cache). Returns every request of the batch, since none of them were returned yet, including those that
+        completed before the error.
+        """
+
+        requests = list(dict.fromkeys(_[0] for _ in batch))
+        for request in requests:
+            if request.latency is None:
+                self.fail(request, error)
+        return requests
+
+    def attribute(self, batch, timings, start_time):
+        """
+        Add the timings of a batch to each of its requests that asked for them, along with how long their
+        segments waited for it, and how much of the batch was theirs.
+        """
+
+        for request in dict.fromkeys(_[0] for _ in batch):
+            if request.timings is None:
+                continue
+            items = [_ for _ in batch if _[0] is request]
+            request.timings.merge(timings)
+            request.timings.add(
+                "queueWait", start_time - min(_[3] for _ in items), segments=len(items)
+            )
+            request.timings.add(
+                "batch", batches=1, segments=len(batch), ownSegments=len(items)
+            )
+
+    def isolate(self, batch):
+        """
+        Transcribe the segments of a failed batch again, one request at a time. Requests that still fail are
+        failed on their own. Returns the requests that are done (completed or failed).
+        """
+
+        done = []
+        for request in dict.fromkeys(_[0] for _ in batch):
+            items = [_ for _ in batch if _[0] is request]
+            try:
+                with stage(request.timings, "retry", segments=len(items)):
+                    results = self.model.transcribe_segments(
+                        [_[2] for _ in items], timings=request.timings
+                    )
+            except Exception as e:
+                if is_fatal_error(e):
+                    raise
+                self.fail(request, traceback.format_exc())
+                done.append(request)
+                continue
+            done.extend(self.add_results(items, results))
+        return done
+
+    def add_results(self, batch, results):
+        completed = []
+        for (request, seg_idx, segment, _), result in zip(batch, results):
+            request.add_result(segment[4]["file_id"], seg_idx, result)
+            if request.done:
+                completed.append(request)
+
+        end_time = time.monotonic()
+        for request in completed:
+            self.requests.remove(request)
+            self.store(request)
+            self.completed += 1
+            self.finish(request)
+            if request.deadline is not None and end_time > request.deadline:
+                self.deadline_misses += 1
+
+        return completed
+
+    def stats(self):
+        return {
+            "pending": {
+                priority: len(queue) for priority, queue in self.pending.items()
+            },
+            "inFlight": len(self.requests),
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "expired": self.expired,
+            "failed": self.failed,
+            "deadlineMisses": self.deadline_misses,
+            "queueWait": {
+                "segments": self.queue_waits,
+                "meanSeconds": self.queue_wait_seconds / max(1, self.queue_waits),
+                "maxSeconds": self.max_queue_wait_seconds,
+            },
+        }
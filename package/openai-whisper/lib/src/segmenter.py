@@ -4,6 +4,8 @@
 # Credits: https://github.com/shashikg/WhisperS2T
 
 from abc import ABC, abstractmethod
+from .frame_vad import SpeechProbs
+from .timings import stage
 import numpy as np
 
 
@@ -34,6 +36,8 @@ class SpeechSegmenter:
         eos_thresh=0.3,
         bos_thresh=0.3,
         cut_factor=2,
+        min_speech_ratio=0.0,
+        min_max_prob=0.0,
         sampling_rate=16000,
     ):
 
@@ -54,6 +58,10 @@ class SpeechSegmenter:
         self.eos_thresh = eos_thresh
         self.bos_thresh = bos_thresh
 
+        # Clips whose fraction of speech frames or peak speech probability fall below these are treated as silent.
+        self.min_speech_ratio = min_speech_ratio
+        self.min_max_prob = min_max_prob
+
         self.cut_factor = cut_factor
         self.cut_idx = int(self.max_seg_len / (self.cut_factor * self.frame_size))
         self.max_idx_in_seg = self.cut_factor * self.cut_idx
@@ -78,7 +86,9 @@ class SpeechSegmenter:
 
         return all(conditions)
 
-    def get_speech_segments(self, speech_probs):
+    def get_speech_segments_loop(self, speech_probs):
+        # Original frame-by-frame implementation, kept as a reference for benchmark.py.
+        speech_probs = np.asarray(speech_probs)
 
         speech_flag, start_idx = False, 0
         speech_segments = []
@@ -138,15 +148,158 @@ class SpeechSegmenter:
 
         return start_ends
 
-    def __call__(self, audio_signal):
-        audio_duration = len(audio_signal) / self.sampling_rate
-        speech_probs = self.vad_model(audio_signal)
-        start_ends = self.get_speech_segments(speech_probs)
+    def to_speech_probs(self, speech_probs):
+        # VAD models returning the legacy [prob, start_time, end_time] array are adapted.
+        if isinstance(speech_probs, SpeechProbs):
+            return speech_probs
+        return SpeechProbs.from_array(speech_probs, self.frame_size)
+
+    def get_speech_segments(self, speech_probs):
+        return self.get_speech_segments_batch([speech_probs])[0]
+
+    def get_speech_segments_batch(self, all_speech_probs):
+        """
+        Vectorised equivalent of get_speech_segments_loop, for the speech probabilities of many clips at once.
+        Each element of all_speech_probs is either a SpeechProbs, or the legacy [prob, start_time, end_time] array.
+        """
+
+        all_speech_probs = list(map(self.to_speech_probs, all_speech_probs))
+
+        # Threshold crossings are found in one pass over every clip. A -inf frame between clips forces an EOS,
+        # and can never start a segment, so segments never run across clips.
+        offsets = np.cumsum([0] + [len(_) + 1 for _ in all_speech_probs])
+        probs = np.full(offsets[-1], -np.inf)
+        for offset, speech_probs in zip(offsets, all_speech_probs):
+            probs[offset : offset + len(speech_probs)] = speech_probs.probs
+
+        bos_idx = np.flatnonzero(probs >= self.bos_thresh)
+        eos_idx = np.flatnonzero(probs < self.eos_thresh)
+
+        # Hysteresis: a segment starts at the first BOS frame, and ends right before the next EOS frame after it.
+        seg_starts, seg_ends = [], []
+        pos = 0
+        while True:
+            i = np.searchsorted(bos_idx, pos)
+            if i == len(bos_idx):
+                break
+            start_idx = bos_idx[i]
+            end_idx = eos_idx[np.searchsorted(eos_idx, start_idx, side="right")]
+            seg_starts.append(start_idx)
+            seg_ends.append(end_idx - 1)
+            pos = end_idx + 1
+
+        seg_starts = np.array(seg_starts, dtype=np.int64)
+        seg_ends = np.array(seg_ends, dtype=np.int64)
+
+        all_start_ends = []
+        for clip_idx, speech_probs in enumerate(all_speech_probs):
+            lo, hi = np.searchsorted(
+                seg_starts, [offsets[clip_idx], offsets[clip_idx + 1]]
+            )
+            all_start_ends.append(
+                self.merge_speech_segments(
+                    speech_probs,
+                    seg_starts[lo:hi] - offsets[clip_idx],
+                    seg_ends[lo:hi] - offsets[clip_idx],
+                )
+            )
 
-        if len(start_ends) == 0:
-            start_ends = [[0.0, self.max_seg_len]]  # Quick fix for silent audio.
+        return all_start_ends
+
+    def merge_speech_segments(self, speech_probs, seg_starts, seg_ends):
+        if len(seg_starts) == 0:
+            return []
+
+        probs = speech_probs.probs
+        start_time, end_time = speech_probs.frame_start, speech_probs.frame_end
+
+        # Merge each segment into the previous one when the silence between them is short enough, and the merged
+        # segment stays within max_seg_len. The gap condition only depends on neighbouring segments.
+        gap_ok = (
+            start_time(seg_starts[1:]) - end_time(seg_ends[:-1])
+        ) < self.max_silent_region
+        merged_starts, merged_ends = [seg_starts[0]], [seg_ends[0]]
+        for k in range(1, len(seg_starts)):
+            if (
+                gap_ok[k - 1]
+                and (end_time(seg_ends[k]) - start_time(merged_starts[-1]))
+                <= self.max_seg_len
+            ):
+                merged_ends[-1] = seg_ends[k]
+            else:
+                merged_starts.append(seg_starts[k])
+                merged_ends.append(seg_ends[k])
 
-        start_ends[0][0] = max(0.0, start_ends[0][0])  # fix edges
-        start_ends[-1][1] = min(audio_duration, start_ends[-1][1])  # fix edges
+        merged_starts = np.array(merged_starts)
+        merged_ends = np.array(merged_ends)
+        keep = (end_time(merged_ends) - start_time(merged_starts)) > self.min_seg_len
 
-        return start_ends, audio_signal
+        # Over-long segments are cut at the least likely speech frame within each cut window.
+        start_ends = []
+        for start_idx, end_idx in zip(merged_starts[keep], merged_ends[keep]):
+            first_idx = len(start_ends)
+            while (end_idx - start_idx) > self.max_idx_in_seg:
+                _start_idx = int(start_idx + self.cut_idx)
+                _end_idx = int(min(end_idx, start_idx + self.max_idx_in_seg))
+
+                new_end_idx = _start_idx + np.argmin(probs[_start_idx:_end_idx])
+                start_ends.append([start_time(start_idx), end_time(new_end_idx)])
+                start_idx = new_end_idx + 1
+
+            start_ends.append([start_time(start_idx), end_time(end_idx) + self.padding])
+            start_ends[first_idx][0] = start_ends[first_idx][0] - self.padding
+
+        return start_ends
+
+    def detect_speech_batch(self, audio_signals, timings=None):
+        # Run the VAD over every clip at once, when the VAD model supports it.
+        with stage(timings, "vad", clips=len(audio_signals)):
+            if hasattr(self.vad_model, "call_batch"):
+                all_speech_probs = self.vad_model.call_batch(audio_signals)
+            else:
+                all_speech_probs = [self.vad_model(_) for _ in audio_signals]
+            all_speech_probs = list(map(self.to_speech_probs, all_speech_probs))
+
+        with stage(timings, "segmentation"):
+            all_start_ends = self.get_speech_segments_batch(all_speech_probs)
+
+            return [
+                self.get_speech(
+                    speech_probs, start_ends, len(audio_signal) / self.sampling_rate
+                )
+                for speech_probs, start_ends, audio_signal in zip(
+                    all_speech_probs, all_start_ends, audio_signals
+                )
+            ]
+
+    def detect_speech(self, audio_signal):
+        return self.detect_speech_batch([audio_signal])[0]
+
+    def segment_batch(self, audio_signals, timings=None):
+        return [
+            _["start_ends"] for _ in self.detect_speech_batch(audio_signals, timings)
+        ]
+
+    def get_speech(self, speech_probs, start_ends, audio_duration):
+        if len(speech_probs) == 0:
+            return {"start_ends": [], "speech_ratio": 0.0, "max_prob": 0.0}
+
+        speech_ratio = float(np.mean(speech_probs.probs >= self.bos_thresh))
+        max_prob = float(np.max(speech_probs.probs))
+
+        # Silent clips return no segments, which lets the caller skip decoding them entirely.
+        if speech_ratio < self.min_speech_ratio or max_prob < self.min_max_prob:
+            start_ends = []
+
+        if len(start_ends) > 0:
+            start_ends[0][0] = max(0.0, start_ends[0][0])  # fix edges
+            start_ends[-1][1] = min(audio_duration, start_ends[-1][1])  # fix edges
+
+        return {
+            "start_ends": start_ends,
+            "speech_ratio": speech_ratio,
+            "max_prob": max_prob,
+        }
+
+    def __call__(self, audio_signal):
+        return self.detect_speech(audio_signal)["start_ends"], audio_signal
@@ -0,0 +1,210 @@
+# Rolling performance counters of the worker, used to size worker counts and batch sizes from live traffic.
+#
+# Rates, means and percentiles cover the last `window` seconds. Rates and means are summed in one bucket per second,
+# so they are exact whatever the traffic. Latency percentiles need the latencies themselves, of which at most
+# max_samples are kept: the response reports how many were used, and whether any had to be dropped. Totals and the
+# latency histogram are cumulative since the worker started. Counters are written by the main loop and read by the
+# stdin reader thread, which answers stats requests while a batch is running, hence the lock.
+
+from bisect import bisect_left
+from collections import deque
+
+import threading
+import time
+
+# Upper bounds (in seconds) of the end-to-end latency histogram buckets. The last bucket is unbounded.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class RollingCounters:
+    def __init__(self, window=60.0, maximums=()):
+        self.window = window
+        # Counters that keep their largest value, rather than their sum.
+        self.maximums = set(maximums)
+        # (second, {counter: value}), oldest first.
+        self.buckets = deque()
+
+    def add(self, now, **counts):
+        second = int(now)
+        if not self.buckets or self.buckets[-1][0] != second:
+            self.buckets.append((second, {}))
+
+        bucket = self.buckets[-1][1]
+        for key, value in counts.items():
+            if key in self.maximums:
+                bucket[key] = max(bucket.get(key, value), value)
+            else:
+                bucket[key] = bucket.get(key, 0) + value
+
+    def totals(self, now):
+        # Buckets are whole seconds, so the oldest one may reach up to a second past the window.
+        while self.buckets and self.buckets[0][0] + 1 <= now - self.window:
+            self.buckets.popleft()
+
+        totals = {}
+        for _, bucket in self.buckets:
+            for key, value in bucket.items():
+                if key in self.maximums:
+                    totals[key] = max(totals.get(key, value), value)
+                else:
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+
+class RollingWindow:
+    def __init__(self, window=60.0, max_samples=10000):
+        self.window = window
+        self.samples = deque(maxlen=max_samples)
+        # Time of the latest sample dropped to stay within max_samples.
+        self.last_dropped = None
+
+    def add(self, value, now):
+        if len(self.samples) == self.samples.maxlen:
+            self.last_dropped = self.samples[0][0]
+        self.samples.append((now, value))
+
+    def values(self, now):
+        while self.samples and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+        return [value for _, value in self.samples]
+
+    def truncated(self, now):
+        """
+        Whether samples within the window were dropped to stay within max_samples.
+        """
+
+        return self.last_dropped is not None and self.last_dropped >= now - self.window
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return {
+            "buckets": [
+                {"le": bound, "count": count}
+                for bound, count in zip((*self.bounds, None), self.counts)
+            ],
+            "count": self.count,
+            "sumSeconds": round(self.sum, 6),
+        }
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of values, or None if there are none.
+    """
+
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+class WorkerStats:
+    def __init__(self, window=60.0):
+        self.window = window
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+
+        self.counters = RollingCounters(window, maximums=("maxQueueDepth",))
+        # End-to-end latencies of finished requests, for percentiles.
+        self.latency_samples = RollingWindow(window)
+
+        self.latencies = Histogram()
+        self.totals = {
+            "requests": 0,
+            "failedRequests": 0,
+            "audioSeconds": 0.0,
+            "batches": 0,
+            "segments": 0,
+        }
+
+    def record_request(self, latency, audio_seconds, status=None):
+        with self.lock:
+            now = time.monotonic()
+            self.totals["requests"] += 1
+            if status is not None:
+                # Cancelled, expired and failed requests don't count towards latency or throughput.
+                self.totals["failedRequests"] += 1
+                return
+            self.counters.add(now, requests=1, audioSeconds=audio_seconds)
+            self.latency_samples.add(latency, now)
+            self.latencies.add(latency)
+            self.totals["audioSeconds"] += audio_seconds
+
+    def record_segmentation(self, audio_seconds, speech_seconds):
+        with self.lock:
+            self.counters.add(
+                time.monotonic(),
+                speechSeconds=speech_seconds,
+                segmentedAudioSeconds=audio_seconds,
+            )
+
+    def record_batch(self, segments, batch_size, seq_lens, queue_depth):
+        with self.lock:
+            now = time.monotonic()
+            # Segments are padded to the longest one of their batch.
+            length_fill = sum(seq_lens) / (len(seq_lens) * max(seq_lens)) if seq_lens else 0.0
+            self.counters.add(
+                now,
+                batches=1,
+                batchFill=segments / batch_size,
+                lengthFill=length_fill,
+                queueDepth=queue_depth,
+                maxQueueDepth=queue_depth,
+            )
+            self.totals["batches"] += 1
+            self.totals["segments"] += segments
+
+    def to_dict(self):
+        with self.lock:
+            now = time.monotonic()
+            elapsed = max(1e-9, min(self.window, now - self.start_time))
+            counters = self.counters.totals(now)
+            latencies = self.latency_samples.values(now)
+            batches = counters.get("batches", 0)
+            segmented_audio_seconds = counters.get("segmentedAudioSeconds", 0)
+
+            return {
+                "windowSeconds": round(elapsed, 3),
+                "requestsPerSecond": round(counters.get("requests", 0) / elapsed, 3),
+                # Audio seconds processed per wall clock second.
+                "audioSecondsPerSecond": round(counters.get("audioSeconds", 0) / elapsed, 3),
+                # Segments over batch size, and the share of each batch's audio that isn't padding.
+                "batchFill": counters["batchFill"] / batches if batches else None,
+                "lengthFill": counters["lengthFill"] / batches if batches else None,
+                # Pending segments whenever a batch is taken.
+                "queueDepth": {
+                    "mean": counters["queueDepth"] / batches if batches else None,
+                    "max": counters.get("maxQueueDepth"),
+                },
+                "speechRatio": (
+                    counters["speechSeconds"] / segmented_audio_seconds
+                    if segmented_audio_seconds > 0
+                    else None
+                ),
+                "latency": {
+                    "p50": percentile(latencies, 50),
+                    "p95": percentile(latencies, 95),
+                    "p99": percentile(latencies, 99),
+                    # Requests the percentiles were taken over, and whether some in the window had to be left out.
+                    "samples": len(latencies),
+                    "truncated": self.latency_samples.truncated(now),
+                    "histogram": self.latencies.to_dict(),
+                },
+                "totals": {
+                    key: round(value, 3) if isinstance(value, float) else value
+                    for key, value in self.totals.items()
+                },
+                "uptimeSeconds": round(now - self.start_time, 3),
+            }
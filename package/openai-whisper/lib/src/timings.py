@@ -0,0 +1,69 @@
+# Per-request breakdown of where the time goes: how long each stage of a transcription took, along with counters
+# such as segments, audio seconds and generated tokens.
+#
+# Timings are threaded through the pipeline as an optional argument. Stages use stage(timings, name), which is a
+# no-op when timings is None, so requests that don't ask for a breakdown don't pay for it.
+#
+# While a torch.profiler capture is running (see src/profiling.py), stages are also labelled in its trace.
+
+from contextlib import contextmanager, nullcontext
+
+import time
+
+# torch.profiler.record_function while a capture is running, None otherwise.
+record_function = None
+
+
+class Timings:
+    def __init__(self):
+        # name -> {"seconds": float, <counter>: number, ...}, in the order stages first ran.
+        self.stages = {}
+
+    def add(self, name, seconds=0.0, **counts):
+        stage = self.stages.setdefault(name, {"seconds": 0.0})
+        stage["seconds"] += seconds
+        for key, value in counts.items():
+            stage[key] = stage.get(key, 0) + value
+
+    @contextmanager
+    def stage(self, name, **counts):
+        start_time = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(name, time.perf_counter() - start_time, **counts)
+
+    def merge(self, other):
+        for name, stage in other.stages.items():
+            self.add(name, **stage)
+
+    def to_dict(self):
+        return {
+            name: {
+                key: round(value, 6) if isinstance(value, float) else value
+                for key, value in stage.items()
+            }
+            for name, stage in self.stages.items()
+        }
+
+
+def stage(timings, name, **counts):
+    """
+    timings.stage(name, **counts), or a no-op when timings is None.
+    """
+
+    if record_function is not None:
+        return _recorded_stage(timings, name, counts)
+    if timings is None:
+        return nullcontext()
+    return timings.stage(name, **counts)
+
+
+@contextmanager
+def _recorded_stage(timings, name, counts):
+    with record_function(name):
+        if timings is None:
+            yield
+        else:
+            with timings.stage(name, **counts):
+                yield
@@ -0,0 +1,7 @@
+# Tests import the worker's modules the way main.py does (from src.model import ...), so lib is put on the path.
+# Run them from the lib directory with: python -m pytest tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
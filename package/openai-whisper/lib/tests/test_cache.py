@@ -0,0 +1,88 @@
+from src.cache import TranscriptionCache
+
+import json
+
+
+def results(text):
+    return [{"text": text, "startTime": 0.0, "endTime": 1.0}]
+
+
+def entry_size(text):
+    return len(json.dumps(results(text)))
+
+
+def test_key_depends_on_samples_options_and_revision():
+    cache = TranscriptionCache(revision="a")
+    key = cache.key(b"\x01\x00", lang="en", task="transcribe")
+
+    assert key == cache.key(b"\x01\x00", task="transcribe", lang="en")
+    assert key != cache.key(b"\x02\x00", lang="en", task="transcribe")
+    assert key != cache.key(b"\x01\x00", lang="de", task="transcribe")
+    assert key != TranscriptionCache(revision="b").key(b"\x01\x00", lang="en", task="transcribe")
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = TranscriptionCache(max_bytes=2 * entry_size("a"))
+    cache.put("a", results("a"))
+    cache.put("b", results("b"))
+    assert cache.get("a") == results("a")
+
+    cache.put("c", results("c"))
+    assert cache.get("b") is None
+    assert cache.get("a") == results("a")
+    assert cache.get("c") == results("c")
+
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["entries"] == 2
+    assert stats["bytes"] <= stats["maxBytes"]
+    assert (stats["hits"], stats["misses"]) == (3, 1)
+
+
+def test_entries_larger_than_the_budget_are_not_kept():
+    cache = TranscriptionCache(max_bytes=entry_size("a") - 1)
+    cache.put("a", results("a"))
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == 0
+
+
+def test_cached_results_cannot_be_mutated():
+    cache = TranscriptionCache()
+    cache.put("a", results("a"))
+    cache.get("a")[0]["text"] = "b"
+    assert cache.get("a") == results("a")
+
+
+def test_sqlite_write_through(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = TranscriptionCache(max_bytes=entry_size("a"), path=path, revision="a")
+    cache.put("a", results("a"))
+    cache.put("b", results("b"))
+
+    # Evicted from memory, but still on disk.
+    assert cache.stats()["evictions"] == 1
+    assert cache.get("a") == results("a")
+    assert cache.stats()["diskHits"] == 1
+    cache.close()
+
+    cache = TranscriptionCache(path=path, revision="a")
+    assert cache.get("a") == results("a")
+    assert cache.get("b") == results("b")
+    assert cache.stats()["diskHits"] == 2
+    cache.close()
+
+
+def test_sqlite_is_cleared_when_the_revision_changes(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = TranscriptionCache(path=path, revision="a")
+    cache.put("a", results("a"))
+    cache.close()
+
+    cache = TranscriptionCache(path=path, revision="b")
+    assert cache.get("a") is None
+    cache.close()
+
+    # The old revision's entries are gone for good, not just hidden.
+    cache = TranscriptionCache(path=path, revision="a")
+    assert cache.get("a") is None
+    cache.close()
@@ -0,0 +1,119 @@
+from itertools import repeat
+from src.audio import to_audio_signal
+from src.loader import WhisperDataLoader, stitch_speech_segments
+from src.tokenizer import NoneTokenizer
+
+import numpy as np
+import tracemalloc
+
+CLIP_SECONDS = 5.0
+
+
+def synthetic_clips(n_clips, seed=0):
+    rng = np.random.default_rng(seed)
+    for _ in range(n_clips):
+        yield (rng.normal(0, 1000, int(CLIP_SECONDS * 16000))).astype(np.int16).tobytes()
+
+
+def peak_memory(loader, audio_signals):
+    """
+    Peak traced memory of batching the audio signals returned by audio_signals().
+    """
+
+    tracemalloc.start()
+    try:
+        batches = loader.get_batches(
+            loader.get_segments(
+                audio_signals(), repeat("en"), repeat("transcribe"), repeat(None), use_vad=False
+            ),
+            batch_size=4,
+        )
+        for _ in batches:
+            pass
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_streaming_memory_stays_flat():
+    loader = WhisperDataLoader("cpu", NoneTokenizer(), None, max_speech_len=5.0)
+
+    streaming = [
+        peak_memory(loader, lambda: map(to_audio_signal, synthetic_clips(n_clips)))
+        for n_clips in (32, 128)
+    ]
+    eager = [
+        peak_memory(loader, lambda: list(map(to_audio_signal, list(synthetic_clips(n_clips)))))
+        for n_clips in (32, 128)
+    ]
+
+    # 4 times the input: eager memory grows with it, while streaming memory only depends on the file groups the VAD
+    # runs on (vad_batch_size clips).
+    assert eager[1] > 2.5 * eager[0]
+    assert streaming[1] < 1.25 * streaming[0]
+    assert streaming[1] < eager[1] / 2
+
+
+def test_max_resident_audio_bounds_memory():
+    clips = lambda: map(to_audio_signal, synthetic_clips(64))
+    unbounded = WhisperDataLoader("cpu", NoneTokenizer(), None, max_speech_len=5.0)
+    bounded = WhisperDataLoader(
+        "cpu", NoneTokenizer(), None, max_speech_len=5.0, max_resident_audio=2 * CLIP_SECONDS
+    )
+
+    assert peak_memory(bounded, clips) < peak_memory(unbounded, clips)
+
+
+def test_streaming_batches_match_eager():
+    loader = WhisperDataLoader("cpu", NoneTokenizer(), None, max_speech_len=5.0)
+
+    def batches(audio_signals):
+        return [
+            [(_["file_id"], _["start_time"], _["end_time"]) for _ in batch[3]]
+            for batch in loader.get_batches(
+                loader.get_segments(
+                    audio_signals, repeat("en"), repeat("transcribe"), repeat(None), use_vad=False
+                ),
+                batch_size=4,
+            )
+        ]
+
+    assert batches(map(to_audio_signal, synthetic_clips(5))) == batches(
+        list(map(to_audio_signal, synthetic_clips(5)))
+    )
+
+
+def test_stitch_speech_segments_keeps_segments_in_order():
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        start_ends, time = [], 0.0
+        for _ in range(int(rng.integers(1, 40))):
+            time += rng.uniform(0.0, 3.0)
+            duration = rng.uniform(0.1, 12.0)
+            start_ends.append([time, time + duration])
+            time += duration
+
+        stitched = stitch_speech_segments(start_ends, max_len=27.0)
+        assert [seg for segs in stitched for seg in segs] == start_ends
+        for segs in stitched:
+            assert sum(end - start for start, end in segs) <= 27.0 or len(segs) == 1
+
+
+def test_packed_windows_share_the_prompt_layout():
+    tokenizer = NoneTokenizer()
+    tokenizer.no_timestamps, tokenizer.timestamp_begin = 1, 2
+    loader = WhisperDataLoader("cpu", tokenizer, None, max_speech_len=7.0)
+    segments = loader.get_segments(
+        map(to_audio_signal, synthetic_clips(3)),
+        repeat("en"),
+        repeat("transcribe"),
+        repeat(None),
+        use_vad=False,
+        start_ends=[[[0.0, 5.0]], [[0.0, 3.0]], [[1.0, 4.0]]],
+    )
+
+    # The first segment is alone in its window, while the other two are packed together. Both windows are decoded
+    # with timestamps, so that they can share a generate call.
+    windows = list(loader.pack_segments(segments))
+    assert [len(_[4]["packed_segs"]) for _ in windows] == [1, 2]
+    assert [_[1] for _ in windows] == [["transcribe", "en", 2]] * 2
@@ -0,0 +1,58 @@
+from src.protocol import FRAME_MARKER, read_message
+from src.timings import Timings
+
+import io
+import json
+import os
+import runpy
+import struct
+import sys
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+
+class StubModel:
+    def __init__(self, model_path, device, compute_type):
+        self.load_timings = Timings()
+
+
+def run_worker(monkeypatch, tmp_path, messages):
+    """
+    Run main.py on the given stdin bytes (after the model path line), and return the messages it answered with.
+    """
+
+    import src.model
+
+    monkeypatch.setattr(src.model, "WhisperModelCT2", StubModel)
+    monkeypatch.chdir(tmp_path)
+
+    stdin = io.TextIOWrapper(io.BytesIO(str(tmp_path).encode("utf-8") + b"\n" + messages))
+    stdout = io.TextIOWrapper(io.BytesIO())
+    monkeypatch.setattr(sys, "stdin", stdin)
+    monkeypatch.setattr(sys, "stdout", stdout)
+    runpy.run_path(MAIN_PATH, run_name="__main__")
+
+    stdout.flush()
+    stream = io.BytesIO(stdout.buffer.getvalue())
+    assert stream.readline() in (b"True\n", b"False\n")
+    responses = []
+    while (response := read_message(stream)) is not None:
+        response[0].pop("decodeSeconds")
+        responses.append(response)
+    return responses
+
+
+def test_messages_that_cannot_be_read_are_answered(monkeypatch, tmp_path):
+    header = json.dumps({"requestId": 8, "clipLengths": [3]}).encode("utf-8")
+    responses = run_worker(
+        monkeypatch,
+        tmp_path,
+        b"{not json\n"
+        + b'{"requestId": 7, "samplesBatch": ["AAA"]}\n'
+        + FRAME_MARKER + struct.pack("<I", len(header)) + header + b"\x01\x00\x02"
+        + b'{"requestId": 9, "queueStats": true}\n',
+    )
+
+    assert [(_[0].get("requestId"), _[1]) for _ in responses] == [(None, False), (7, False), (8, True), (9, False)]
+    assert all("ProtocolError" in _[0]["exception"] for _ in responses[:3])
+    assert "response" in responses[3][0]
@@ -0,0 +1,133 @@
+from src.model import ASR_PROFILES, WhisperModelCT2, budget_groups, build_asr_profiles, find_repetition_loop
+from types import SimpleNamespace
+
+EOT = 100
+TIMESTAMP_BEGIN = 200
+
+
+def timestamp(seconds):
+    return TIMESTAMP_BEGIN + round(seconds / 0.02)
+
+
+def test_no_repetition_loop():
+    assert find_repetition_loop(list(range(40))) is None
+    # Repeats, but fewer than min_repeats, or fewer than min_tokens in total.
+    assert find_repetition_loop([1, 2, 1, 2, 3, 4]) is None
+    assert find_repetition_loop([9] * 10) is None
+
+
+def test_repetition_loop_keeps_the_first_repeat():
+    assert find_repetition_loop([1, 2, 3] + [9] * 20) == 4
+    assert find_repetition_loop([1, 2, 3] + [5, 6, 7] * 6) == 6
+
+
+def test_repetition_loop_cut_off_partway():
+    tokens = [1, 2, 3] + [5, 6, 7] * 6 + [5]
+    assert tokens[: find_repetition_loop(tokens)] == [1, 2, 3, 5, 6, 7]
+
+
+def test_repetition_loop_options():
+    tokens = [1, 2, 3] + [5, 6, 7, 8] * 5
+    assert find_repetition_loop(tokens, max_ngram=3) is None
+    assert find_repetition_loop(tokens, max_ngram=4) == 7
+    assert find_repetition_loop(tokens, min_repeats=6) is None
+
+
+def split_packed_tokens(tokens, packed_segs):
+    tokenizer = SimpleNamespace(
+        eot=EOT,
+        timestamp_begin=TIMESTAMP_BEGIN,
+        decode=lambda tokens: " ".join(f"w{_}" for _ in tokens),
+    )
+    model = SimpleNamespace(tokenizer=tokenizer, pack_gap=1.0)
+    return WhisperModelCT2.split_packed_tokens(model, tokens, packed_segs)
+
+
+def test_split_packed_tokens():
+    # Two segments packed with a 1 s gap between them.
+    packed_segs = [(0.0, 2.0), (3.0, 5.0)]
+    tokens = [
+        timestamp(0.0), 1, 2, timestamp(1.8),
+        timestamp(3.2), 3, timestamp(4.8),
+    ]
+    assert split_packed_tokens(tokens, packed_segs) == ["w1 w2", "w3"]
+
+
+def test_split_packed_tokens_assigns_spans_by_midpoint():
+    packed_segs = [(0.0, 2.0), (3.0, 5.0), (6.0, 8.0)]
+    tokens = [
+        timestamp(0.0), 1, timestamp(1.0),
+        # Spans the gap, but mostly lies in the first segment.
+        timestamp(1.0), 2, timestamp(3.5),
+        # Falls within the gap: assigned to the nearest segment.
+        timestamp(5.3), 3, timestamp(5.5),
+        # No closing timestamp: runs to the end of the window.
+        timestamp(6.5), 4, EOT,
+    ]
+    assert split_packed_tokens(tokens, packed_segs) == ["w1 w2", "w3", "w4"]
+
+
+def test_split_packed_tokens_without_speech():
+    assert split_packed_tokens([], [(0.0, 2.0), (3.0, 5.0)]) == ["", ""]
+
+
+def test_budget_groups():
+    assert budget_groups([]) == []
+    assert budget_groups([20, 20, 20]) == [[0, 1, 2]]
+    assert budget_groups([316, 28, 40, 300, 28]) == [[0, 3], [1, 2, 4]]
+
+    budgets = [16, 17, 30, 33, 64, 100, 129, 448]
+    groups = budget_groups(budgets)
+    assert sorted(idx for group in groups for idx in group) == list(range(len(budgets)))
+    for group in groups:
+        assert all(2 * budgets[idx] > max(budgets[_] for _ in group) for idx in group)
+
+
+def test_asr_profiles_share_no_state():
+    overrides = {"suppress_tokens": [1, 2]}
+    profiles = build_asr_profiles(overrides)
+    assert set(profiles) == set(ASR_PROFILES)
+    assert all(_["suppress_tokens"] == [1, 2] for _ in profiles.values())
+
+    profiles["latency"]["suppress_tokens"].append(3)
+    assert profiles["quality"]["suppress_tokens"] == [1, 2]
+    assert overrides["suppress_tokens"] == [1, 2]
+
+    # Nor do models built from the same options.
+    build_asr_profiles({})["latency"]["suppress_tokens"].append(3)
+    assert ASR_PROFILES["latency"]["suppress_tokens"] == [-1]
+
+
+def decode_segments(sequences, budgets):
+    """
+    Run WhisperModelCT2.decode_segments over sequences a stub decoder generates, up to each call's max_length.
+    """
+
+    def generate(indices, prompts, max_length, **kwargs):
+        return [SimpleNamespace(sequences_ids=[sequences[_][:max_length]]) for _ in indices]
+
+    model = SimpleNamespace(
+        model=SimpleNamespace(generate=generate),
+        tokenizer=SimpleNamespace(decode_batch=lambda batch: [" ".join(map(str, _)) for _ in batch]),
+        token_budgets=lambda *args: budgets,
+        select_features=lambda encoder_output, indices: indices,
+    )
+    asr_options = {
+        "repetition_loop_max_ngram": 8,
+        "repetition_loop_min_repeats": 3,
+        "repetition_loop_min_tokens": 16,
+        "word_timestamps": False,
+    }
+    generate_kwargs = {"max_length": max(budgets), "return_scores": False, "return_no_speech_prob": False}
+    return WhisperModelCT2.decode_segments(
+        model, None, None, [[]] * len(sequences), None, [{}] * len(sequences), asr_options, generate_kwargs
+    )
+
+
+def test_decode_segments_flags_truncated_segments():
+    # The segments share a generate call, which runs to the largest budget.
+    sequences = [list(range(25)), list(range(10)), list(range(40))]
+    response = decode_segments(sequences, budgets=[20, 30, 30])
+
+    assert [len(_["text"].split()) for _ in response] == [20, 10, 30]
+    assert [_.get("truncated", False) for _ in response] == [True, False, True]
@@ -0,0 +1,122 @@
+from src.protocol import FRAME_MARKER, ProtocolError, read_message, write_message
+
+import base64
+import io
+import json
+import pytest
+import struct
+
+
+def frame(header, payload=b""):
+    header = json.dumps(header).encode("utf-8")
+    return FRAME_MARKER + struct.pack("<I", len(header)) + header + payload
+
+
+def test_json_round_trip():
+    clips = [b"\x01\x00\x02\x00", b"\xff\x7f"]
+    stream = io.BytesIO(
+        (
+            json.dumps(
+                {
+                    "requestId": 1,
+                    "language": ["en", "de"],
+                    "samplesBatch": [base64.b64encode(_).decode("ascii") for _ in clips],
+                }
+            )
+            + "\n"
+        ).encode("utf-8")
+    )
+
+    request, binary = read_message(stream)
+    assert not binary
+    assert request["requestId"] == 1
+    assert request["language"] == ["en", "de"]
+    assert request["samplesBatch"] == clips
+    assert request["decodeSeconds"] >= 0.0
+    assert read_message(stream) is None
+
+
+def test_binary_round_trip():
+    clips = [b"\x01\x00\x02\x00", b"", b"\xff\x7f"]
+    stream = io.BytesIO(
+        frame({"requestId": "a", "clipLengths": list(map(len, clips))}, b"".join(clips))
+    )
+
+    request, binary = read_message(stream)
+    assert binary
+    assert request["requestId"] == "a"
+    assert "clipLengths" not in request
+    assert [bytes(_) for _ in request["samplesBatch"]] == clips
+    assert read_message(stream) is None
+
+
+def test_mixed_encodings():
+    stream = io.BytesIO(
+        b"\n"
+        + frame({"requestId": 1, "clipLengths": [2]}, b"\x01\x00")
+        + b'{"requestId": 2, "cacheStats": true}\n'
+        + frame({"requestId": 3, "cancel": 1})
+    )
+
+    messages = []
+    while (message := read_message(stream)) is not None:
+        messages.append((message[0]["requestId"], message[1]))
+    assert messages == [(1, True), (2, False), (3, True)]
+
+
+def test_write_message_matches_the_request_encoding():
+    response = {"requestId": 1, "response": [{"text": "hello"}]}
+
+    stream = io.BytesIO()
+    write_message(stream, response)
+    assert json.loads(stream.getvalue().decode("utf-8")) == response
+    assert stream.getvalue().endswith(b"\n")
+
+    stream = io.BytesIO()
+    write_message(stream, response, binary=True)
+    stream.seek(1)
+    (length,) = struct.unpack("<I", stream.read(4))
+    assert stream.getvalue()[:1] == FRAME_MARKER
+    assert json.loads(stream.read(length).decode("utf-8")) == response
+    assert stream.read() == b""
+
+
+def test_truncated_frame():
+    stream = io.BytesIO(frame({"clipLengths": [4]}, b"\x01\x00"))
+    with pytest.raises(ProtocolError):
+        read_message(stream)
+
+
+def test_odd_clip_length():
+    stream = io.BytesIO(
+        frame({"requestId": 1, "clipLengths": [3]}, b"\x01\x00\x02")
+        + frame({"requestId": 2, "clipLengths": [2]}, b"\x01\x00")
+    )
+    with pytest.raises(ProtocolError):
+        read_message(stream)
+
+    # The bad frame's payload is skipped, so the stream stays in sync.
+    request, binary = read_message(stream)
+    assert binary
+    assert request["requestId"] == 2
+    assert [bytes(_) for _ in request["samplesBatch"]] == [b"\x01\x00"]
+
+
+def test_read_errors_tell_how_to_answer_them():
+    stream = io.BytesIO(
+        b"{not json\n"
+        + b'{"requestId": 7, "samplesBatch": ["AAA"]}\n'
+        + frame({"requestId": 8, "clipLengths": [3]}, b"\x01\x00\x02")
+        + FRAME_MARKER + struct.pack("<I", 5) + b"[1, 2"
+        + b'{"requestId": 9}\n'
+    )
+
+    errors = []
+    for _ in range(4):
+        with pytest.raises(ProtocolError) as error:
+            read_message(stream)
+        errors.append((error.value.request_id, error.value.binary))
+    assert errors == [(None, False), (7, False), (8, True), (None, True)]
+
+    # The stream is still in sync after each of them.
+    assert read_message(stream)[0]["requestId"] == 9
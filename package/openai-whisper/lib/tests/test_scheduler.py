@@ -0,0 +1,176 @@
+from src.cache import TranscriptionCache
+from src.loader import WhisperDataLoader
+from src.scheduler import BatchScheduler, TranscriptionRequest
+from src.tokenizer import NoneTokenizer
+
+import numpy as np
+import pytest
+import time
+
+# Segments of this many samples make the stub model fail.
+BAD_SEQ_LEN = 3 * 16000
+
+
+class StubModel:
+    """
+    Transcribes each segment as "<file_id>@<start_time>", and fails any batch holding a segment of BAD_SEQ_LEN.
+    """
+
+    def __init__(self):
+        self.data_loader = WhisperDataLoader("cpu", NoneTokenizer(), None, max_speech_len=5.0)
+        self.data_loader.speech_segmenter = self.data_loader.basic_segmenter
+        self.batches = []
+
+    def profile_name(self, profile=None):
+        if profile not in (None, "latency", "quality"):
+            raise ValueError(f"Unknown ASR profile: {profile}")
+        return profile or "latency"
+
+    def get_profile(self, profile=None):
+        return {"profile": self.profile_name(profile)}, {}
+
+    def transcribe_segments(self, segments, timings=None):
+        self.batches.append([(_[4]["file_id"], _[4]["start_time"], _[4]["profile"]) for _ in segments])
+        if any(_[3] == BAD_SEQ_LEN for _ in segments):
+            raise RuntimeError("bad segment")
+        return [{"text": f"{_[4]['file_id']}@{_[4]['start_time']}"} for _ in segments]
+
+
+def clip(seconds, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.normal(0, 1000, int(seconds * 16000))).astype(np.int16).tobytes()
+
+
+def run(scheduler):
+    done = []
+    while scheduler.timeout() is not None:
+        done.extend(scheduler.run_batch())
+    return done
+
+
+def texts(request):
+    return [_["text"] for _ in request.response()]
+
+
+def test_requests_complete():
+    model = StubModel()
+    scheduler = BatchScheduler(model, batch_size=2, max_wait=0.0)
+    requests = [TranscriptionRequest(idx, [clip(12), clip(4)]) for idx in range(2)]
+    for request in requests:
+        assert scheduler.submit(request) == []
+
+    assert run(scheduler) == requests
+    assert texts(requests[0]) == ["0@0", "0@5", "0@10", "1@0"]
+    # Segments of both requests share batches.
+    assert [len(_) for _ in model.batches] == [2, 2, 2, 2]
+
+
+def test_batches_wait_for_max_wait():
+    scheduler = BatchScheduler(StubModel(), batch_size=4, max_wait=10.0)
+    assert scheduler.timeout() is None
+
+    scheduler.submit(TranscriptionRequest(0, [clip(4)]))
+    assert 0.0 < scheduler.timeout() <= 10.0
+
+    scheduler.submit(TranscriptionRequest(1, [clip(12)]))
+    assert scheduler.timeout() == 0.0
+
+
+def test_errors_after_decoding_fail_the_batch():
+    class FailingCache(TranscriptionCache):
+        def put(self, key, results):
+            raise OSError("disk full")
+
+    scheduler = BatchScheduler(StubModel(), batch_size=2, max_wait=0.0, cache=FailingCache())
+    requests = [TranscriptionRequest(idx, [clip(4, seed=idx)]) for idx in range(3)]
+    for request in requests:
+        scheduler.submit(request)
+
+    assert scheduler.run_batch() == requests[:2]
+    assert all("disk full" in _.message()["exception"] for _ in requests[:2])
+    assert scheduler.pending_count() == 1
+
+
+def test_profiles_never_share_a_batch():
+    model = StubModel()
+    scheduler = BatchScheduler(model, batch_size=4, max_wait=0.0)
+    for idx, profile in enumerate([None, "quality", "latency", "quality"]):
+        scheduler.submit(TranscriptionRequest(idx, [clip(4)], profile=profile))
+
+    with pytest.raises(ValueError):
+        scheduler.submit(TranscriptionRequest("unknown", [clip(4)], profile="unknown"))
+
+    run(scheduler)
+    # Requests without a profile use the default one, and are batched with those naming it.
+    assert [{_[2] for _ in batch} for batch in model.batches] == [{"latency"}, {"quality"}]
+    assert [len(batch) for batch in model.batches] == [2, 2]
+
+def test_cancel():
+    model = StubModel()
+    scheduler = BatchScheduler(model, batch_size=2, max_wait=0.0)
+    kept, cancelled = TranscriptionRequest("kept", [clip(10)]), TranscriptionRequest("cancelled", [clip(10)])
+    scheduler.submit(kept)
+    scheduler.submit(cancelled)
+
+    assert scheduler.cancel("cancelled") == [cancelled]
+    assert scheduler.cancel("unknown") == []
+    assert cancelled.message() == {"cancelled": True}
+    assert scheduler.pending_count() == 2
+
+    assert run(scheduler) == [kept]
+    assert all(_[0] == 0 for batch in model.batches for _ in batch)
+    assert scheduler.stats()["cancelled"] == 1
+
+
+def test_expire():
+    scheduler = BatchScheduler(StubModel(), batch_size=2, max_wait=0.0)
+    late = TranscriptionRequest("late", [clip(10)], deadline_ms=10)
+    on_time = TranscriptionRequest("on time", [clip(10)])
+    scheduler.submit(late)
+    scheduler.submit(on_time)
+    time.sleep(0.02)
+
+    assert run(scheduler) == [late, on_time]
+    assert late.message() == {"expired": True}
+    assert texts(on_time) == ["0@0", "0@5"]
+    assert scheduler.stats()["expired"] == 1
+
+
+def test_deadlines_count_from_receipt():
+    scheduler = BatchScheduler(StubModel(), batch_size=2, max_wait=0.0)
+    # Received 20 ms ago, e.g. while the previous batch was running.
+    late = TranscriptionRequest("late", [clip(10)], deadline_ms=10, receive_time=time.monotonic() - 0.02)
+    scheduler.submit(late)
+
+    assert run(scheduler) == [late]
+    assert late.message() == {"expired": True}
+
+
+def test_priorities():
+    scheduler = BatchScheduler(StubModel(), batch_size=2, max_wait=0.0)
+    requests = [
+        TranscriptionRequest(priority, [clip(10)], priority=priority)
+        for priority in ("low", "normal", "high")
+    ]
+    for request in requests:
+        scheduler.submit(request)
+
+    assert [_.request_id for _ in run(scheduler)] == ["high", "normal", "low"]
+
+    with pytest.raises(ValueError):
+        TranscriptionRequest("urgent", [clip(1)], priority="urgent")
+
+
+def test_failures_are_isolated():
+    model = StubModel()
+    scheduler = BatchScheduler(model, batch_size=4, max_wait=0.0)
+    good, bad = TranscriptionRequest("good", [clip(4)]), TranscriptionRequest("bad", [clip(3)])
+    scheduler.submit(good)
+    scheduler.submit(bad)
+
+    assert run(scheduler) == [good, bad]
+    assert texts(good) == ["0@0"]
+    assert "bad segment" in bad.message()["exception"]
+    # The failed batch, then each of its requests on its own.
+    assert [len(_) for _ in model.batches] == [2, 1, 1]
+    assert scheduler.stats()["failed"] == 1
@@ -0,0 +1,64 @@
+from src.frame_vad import SpeechProbs
+from src.segmenter import SpeechSegmenter
+
+import numpy as np
+import pytest
+
+FRAME_SIZE = 0.02
+
+
+def speech_probs(n_frames, seed):
+    """
+    Alternating bursts of speech and silence, like a VAD's output.
+    """
+
+    rng = np.random.default_rng(seed)
+    probs = np.empty(n_frames, dtype=np.float32)
+    idx, speech = 0, bool(rng.integers(2))
+    while idx < n_frames:
+        run = int(rng.exponential(2.0 if speech else 0.5) / FRAME_SIZE) + 1
+        level = 0.9 if speech else 0.05
+        probs[idx : idx + run] = np.clip(level + rng.normal(0, 0.2, min(run, n_frames - idx)), 0, 1)
+        idx += run
+        speech = not speech
+    return SpeechProbs(probs, FRAME_SIZE, n_frames * FRAME_SIZE)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"max_seg_len": 8.0},
+        {"max_silent_region": 0.0, "padding": 0.0},
+        {"eos_thresh": 0.5, "bos_thresh": 0.7, "min_seg_len": 1.0},
+    ],
+)
+def test_vectorised_segments_match_the_loop(options):
+    segmenter = SpeechSegmenter(base_path=None, vad_model=object(), **options)
+    for seed in range(50):
+        probs = speech_probs(int(np.random.default_rng(seed).integers(1, 5000)), seed)
+        expected = segmenter.get_speech_segments_loop(probs.to_array())
+        segments = segmenter.get_speech_segments(probs)
+        assert len(segments) == len(expected)
+        assert np.allclose(np.asarray(segments, dtype=float).reshape(-1, 2), np.asarray(expected).reshape(-1, 2))
+
+
+def test_batch_matches_single_clips():
+    segmenter = SpeechSegmenter(base_path=None, vad_model=object())
+    all_probs = [speech_probs(n_frames, seed) for seed, n_frames in enumerate([1, 50, 3000, 1500])]
+    assert segmenter.get_speech_segments_batch(all_probs) == [
+        segmenter.get_speech_segments(_) for _ in all_probs
+    ]
+
+
+def test_legacy_speech_probs_arrays():
+    segmenter = SpeechSegmenter(base_path=None, vad_model=object())
+    probs = speech_probs(3000, 0)
+    assert segmenter.get_speech_segments(probs.to_array()) == segmenter.get_speech_segments(probs)
+
+
+def test_silence():
+    segmenter = SpeechSegmenter(base_path=None, vad_model=object())
+    probs = SpeechProbs(np.zeros(500, dtype=np.float32), FRAME_SIZE, 10.0)
+    assert segmenter.get_speech_segments(probs) == []
+    assert segmenter.get_speech_segments_loop(probs.to_array()) == []